@@ -0,0 +1,292 @@
+"""Time every stage of frames2osb on synthetic frame sets.
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --output new.json --compare results.json
+
+Every case runs in its own process, so module state and peak memory don't leak
+from one case to the next. Frames are generated from a fixed seed, so results
+of two runs can be compared directly."""
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Literal, Optional
+
+import numpy as np
+from PIL import Image
+from tap import Tap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+FrameSet = Literal["static", "noise", "gradient", "video"]
+FRAME_SETS = ["static", "noise", "gradient", "video"]
+SEED = 727
+
+
+class BenchParser(Tap):
+    sets: List[FrameSet] = FRAME_SETS  # Synthetic frame sets to run.
+    methods: List[Literal["pixels", "quadtree"]] = ["pixels", "quadtree"]
+    sizes: List[int] = [8, 4]  # Pixels sizes to run.
+    qualities: List[int] = [6, 8]  # Quadtree qualities to run.
+    rgb: List[bool] = [False, True]  # use_rgb values to run.
+    passes: List[Literal["single", "two_pass"]] = [
+        "single",
+        "two_pass",
+    ]  # Modes to run.
+    frames: int = 120  # Number of frames in every set.
+    width: int = 640  # Width of the generated frames.
+    height: int = 360  # Height of the generated frames.
+    jobs: int = 2  # Number of processes to use.
+    splits: int = 16  # Number of splits to extract.
+    max_buffered: int = 1000000  # Commands kept in memory before spilling to disk.
+    output: str = "benchmark_results.json"  # Where to write the results.
+    compare: Optional[str] = None  # Earlier results to compare against.
+
+
+def make_frame(frame_set: str, i: int, width: int, height: int) -> np.ndarray:
+    rng = np.random.default_rng(SEED + i)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+
+    if frame_set == "static":
+        gray = xs / width * 255
+        return np.stack([gray, ys / height * 255, 255 - gray], axis=2).astype(np.uint8)
+
+    if frame_set == "noise":
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    if frame_set == "gradient":
+        phase = (xs + ys + i * 8) / (width + height) * 2 * np.pi
+        channels = [np.sin(phase + shift) * 127 + 128 for shift in (0, 2, 4)]
+        return np.stack(channels, axis=2).astype(np.uint8)
+
+    # Something like a video: a slow background, a few moving shapes, a bit of grain.
+    background = (ys / height * 160 + 40 + 20 * np.sin(i / 15))[..., None]
+    image = np.repeat(background, 3, axis=2)
+    shapes = np.random.default_rng(SEED)
+    for _ in range(6):
+        cx, cy = shapes.uniform(0, width), shapes.uniform(0, height)
+        vx, vy = shapes.uniform(-4, 4, size=2)
+        radius = shapes.uniform(height / 20, height / 6)
+        colour = shapes.integers(0, 256, 3)
+        inside = (xs - (cx + vx * i) % width) ** 2 + (
+            ys - (cy + vy * i) % height
+        ) ** 2 < radius**2
+        image[inside] = colour
+    image += rng.normal(0, 3, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def write_frames(directory: str, frame_set: str, args: BenchParser):
+    frames_dir = os.path.join(directory, "frames")
+    os.makedirs(frames_dir)
+    for i in range(args.frames):
+        image = Image.fromarray(make_frame(frame_set, i, args.width, args.height))
+        image.save(os.path.join(frames_dir, f"{i + 1:03d}.jpg"), quality=90)
+
+
+def directory_size(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # macOS reports bytes, everything else kilobytes.
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_case(case: Dict[str, Any], args: BenchParser, queue: Any):
+    from frames2osb.external.osbpy import Osbject
+
+    if case["method"] == "pixels":
+        from frames2osb.pixels import fused, osb, pixel_extract
+    else:
+        from frames2osb.quadtree import fused, osb, pixel_extract  # type: ignore
+
+    times = {"write": 0.0}
+
+    def timed(write):
+        def timed_write(*write_args):
+            start = time.perf_counter()
+            try:
+                return write(*write_args)
+            finally:
+                times["write"] += time.perf_counter() - start
+
+        return timed_write
+
+    # The .osb is written by Osbject.end, or joined from parts by join_parts when
+    # it was generated in parts.
+    Osbject.end = timed(Osbject.end)  # type: ignore
+    Osbject.join_parts = timed(Osbject.join_parts)  # type: ignore
+    Osbject.enable_spill(args.max_buffered)
+    splits = min(args.splits, args.frames)
+
+    result: Dict[str, Any] = dict(case)
+    start = time.perf_counter()
+    if case["pass"] == "single":
+        fused.run(
+            case["setting"],
+            "bench.osb",
+            case["use_rgb"],
+            number_of_thread=args.jobs,
+            number_of_splits=splits,
+        )
+    else:
+        pixel_extract.run(
+            case["setting"],
+            case["use_rgb"],
+            number_of_thread=args.jobs,
+            number_of_splits=splits,
+        )
+        extract = time.perf_counter() - start
+        result["extract_s"] = round(extract, 4)
+        result["extract_fps"] = round(args.frames / extract, 2)
+        result["extract_peak_rss_kb"] = peak_rss_kb()
+
+        generate_start = time.perf_counter()
+        osb.generate_osb(
+            case["setting"],
+            "bench.osb",
+            use_rgb=case["use_rgb"],
+            number_of_jobs=args.jobs,
+        )
+        generate = time.perf_counter() - generate_start - times["write"]
+        result["generate_s"] = round(generate, 4)
+        result["generate_fps"] = round(args.frames / generate, 2)
+    total = time.perf_counter() - start
+
+    queue.put(
+        {
+            **result,
+            "total_s": round(total, 4),
+            "write_s": round(times["write"], 4),
+            "fps": round(args.frames / total, 2),
+            "peak_rss_kb": peak_rss_kb(),
+            "datas_bytes": directory_size("datas"),
+            "osb_bytes": os.path.getsize("bench.osb"),
+        }
+    )
+
+
+def _run_in_directory(directory: str, case: Dict[str, Any], args: BenchParser, queue):
+    os.chdir(directory)
+    run_case(case, args, queue)
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return "{set} {method} {setting} {rgb} {pass}".format(
+        rgb="rgb" if case["use_rgb"] else "alpha", **case
+    )
+
+
+def cases(args: BenchParser) -> List[Dict[str, Any]]:
+    result = []
+    for method in args.methods:
+        settings = args.sizes if method == "pixels" else args.qualities
+        for setting in settings:
+            for use_rgb in args.rgb:
+                for mode in args.passes:
+                    result.append(
+                        {
+                            "method": method,
+                            "setting": setting,
+                            "use_rgb": use_rgb,
+                            "pass": mode,
+                        }
+                    )
+    return result
+
+
+def compare(results: List[Dict[str, Any]], filename: str):
+    with open(filename) as f:
+        previous = {case_key(r): r for r in json.load(f)["results"]}
+
+    print(f"\nCompared to {filename} (new / old):")
+    for result in results:
+        old = previous.get(case_key(result))
+        if not old:
+            continue
+        ratios = [
+            f"{field} {result[field] / old[field]:.2f}x"
+            for field in ("total_s", "extract_s", "generate_s", "write_s", "osb_bytes")
+            if field in result
+            if old.get(field)
+        ]
+        print(f"  {case_key(result):<37} " + "  ".join(ratios))
+
+
+def main():
+    args = BenchParser().parse_args()
+    context = multiprocessing.get_context("spawn")
+
+    results: List[Dict[str, Any]] = []
+    for frame_set in args.sets:
+        with tempfile.TemporaryDirectory(prefix=f"bench_{frame_set}_") as directory:
+            write_frames(directory, frame_set, args)
+            for case in cases(args):
+                case = {"set": frame_set, **case}
+                queue = context.Queue()
+                process = context.Process(
+                    target=_run_in_directory, args=(directory, case, args, queue)
+                )
+                process.start()
+                process.join()
+                print()
+                if process.exitcode:
+                    print(f"{case_key(case):<37} failed")
+                    continue
+
+                result = queue.get()
+                results.append(result)
+                stages = "".join(
+                    f"{stage} {result[stage + '_s']:.3f}s "
+                    for stage in ("extract", "generate")
+                    if stage + "_s" in result
+                )
+                print(
+                    f"{case_key(result):<37} total {result['total_s']:.3f}s {stages}"
+                    f"write {result['write_s']:.3f}s "
+                    f"rss {result['peak_rss_kb']} KB osb {result['osb_bytes']} B"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count(),
+                    "frames": args.frames,
+                    "width": args.width,
+                    "height": args.height,
+                    "jobs": args.jobs,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
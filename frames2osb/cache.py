@@ -0,0 +1,78 @@
+import hashlib
+import os
+from typing import Any, List, Optional, Tuple
+
+# Bump when what gets stored for a frame changes, old entries are then never hit.
+CACHE_VERSION = 2
+
+
+class FrameCache:
+    """Per-frame extraction results, stored by the frame's content and settings.
+
+    An entry is a file named after the hash of the frame file's bytes and whatever
+    the result depends on, so replacing a frame or changing a setting just misses.
+    Reading an entry bumps its mtime, and evict removes the least recently used
+    entries once the cache is over max_size bytes."""
+
+    def __init__(self, directory: str = "cache", max_size: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, path: str, *settings: Any) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        digest.update(repr((CACHE_VERSION,) + settings).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by someone else in the meantime, we still got the data.
+            pass
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Several processes may write the same frame, never let them see half of it.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        entries: List[Tuple[float, int, str]] = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
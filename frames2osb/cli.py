@@ -1,9 +1,33 @@
 import argparse
-from typing import TYPE_CHECKING, Literal, Optional, cast
+import math
+import os
+from functools import partial
+from typing import TYPE_CHECKING, Iterator, Literal, Optional, Tuple, cast
 
+import numpy as np
+from numpy.typing import NDArray
 from tap import Tap
 
-from frames2osb.convert import convert_video
+from frames2osb import profiling
+from frames2osb.cache import FrameCache
+from frames2osb.convert import (
+    convert_video,
+    count_frames,
+    get_fps,
+    open_video,
+    stream_frames,
+)
+from frames2osb.external.osbpy import Osbject
+from frames2osb.helper import (
+    FrameSource,
+    average_frames,
+    decimation,
+    get_max_resolution,
+    set_frame_source,
+    set_source_size,
+)
+from frames2osb.optimize import fit_linear
+from frames2osb.stack import FrameStack
 
 
 class QualityAction(argparse.Action):
@@ -22,13 +46,27 @@ class QualityAction(argparse.Action):
 
 
 class CommonParser(Tap):
-    jobs: int = 2  # Number of threads to spawn.
+    if TYPE_CHECKING:
+        # Parsed by CLIParser, ahead of the method, and shared through its namespace.
+        video: Optional[str]
+        stream: bool
+        total_frames: int
+    jobs: int = 2  # Processes to use, single-pass generation always uses one.
     splits: int = 16  # Number of splits to generate.
     fps: int = 30  # Set storyboard's FPS.
     precision: int = 1  # Transparency precision level.
     offset: int = 1  # Set storyboard's offset.
-    only_generate: bool = False  # Only generate storyboard.
+    only_generate: bool = False  # Generate from datas/, which only --two_pass writes.
     use_rgb: bool = False  # Use RGB instead of alpha value.
+    max_buffered: int = 1000000  # Commands kept in memory before spilling to disk.
+    fit: float = 0  # Merge gradual fades/colours into ranged ones, within this (0-1).
+    cache_size: int = 1024  # Size limit of the per-frame cache in MB, 0 to disable it.
+    profile: Optional[str] = None  # Write a JSON report of time spent per stage here.
+    cprofile: Optional[str] = None  # With --profile, dump a cProfile per task here.
+    two_pass: bool = False  # Extract into datas/ first, to reuse with --only_generate.
+    stack: bool = False  # Keep the resized frames in stacks/ for later runs to reuse.
+    static_threshold: int = -1  # Skip frames this close (0-255) to the last kept one.
+    rate: float = 0  # Storyboard frames per second, averaging frames down to it.
     outfile: str
 
     def configure(self) -> None:
@@ -37,6 +75,7 @@ class CommonParser(Tap):
 
 class PixelParser(CommonParser):
     size: int
+    threshold: int = 0  # Ignore changes of a pixel up to this much (0-255) per channel.
 
     def configure(self):
         super().configure()
@@ -46,6 +85,9 @@ class PixelParser(CommonParser):
 
 class QuadTreeParser(CommonParser):
     quality: int
+    max_error: float = 0  # Split blocks whose std. deviation is above this.
+    max_leaves: int = 0  # Most leaves (sprites shown) per frame, 0 for no limit.
+    temporal: bool = False  # Build trees against the last one's, needs --max_error.
 
     def configure(self) -> None:
         super().configure()
@@ -61,7 +103,9 @@ class CLIParser(Tap):
     if TYPE_CHECKING:
         method: Literal["pixels", "quadtree"]
         fps: float
+        total_frames: int
     video: Optional[str] = None
+    stream: bool = False  # Decode video straight from ffmpeg instead of into frames/.
 
     def configure(self) -> None:
         self.add_subparsers(required=True, dest="method")
@@ -77,60 +121,258 @@ class CLIParser(Tap):
         )
 
 
+def frame_cache(args: CommonParser) -> Optional[FrameCache]:
+    if args.cache_size <= 0:
+        return None
+    return FrameCache("cache", args.cache_size * 1024 * 1024)
+
+
+def frame_stack(args: CommonParser, obj_size: int) -> Optional[FrameStack]:
+    "The frames resized for obj_size, resized now unless an earlier run did."
+    if not args.stack or args.only_generate:
+        return None
+
+    x_max, y_max, _ = get_max_resolution(obj_size)
+    stack = FrameStack(x_max, y_max, args.use_rgb)
+    if not stack.is_built():
+        print(f"> Resizing frames into {stack.filename}")
+        with profiling.stage("stacking"):
+            stack.build(args.jobs, args.splits)
+    return stack
+
+
+def video_frames(
+    args: CommonParser, obj_size: int, factor: int
+) -> Tuple[Iterator[NDArray[np.uint8]], int]:
+    "Frames streamed from --video, averaged by factor, and how many there are."
+    assert args.video
+    x_max, y_max, _ = get_max_resolution(obj_size)
+    frames = stream_frames(args.video, x_max, y_max, args.use_rgb)
+    return average_frames(frames, factor), math.ceil(args.total_frames / factor)
+
+
+def setup_writer(args: CommonParser):
+    Osbject.enable_spill(args.max_buffered)
+    if args.fit > 0:
+        Osbject.add_optimizer(partial(fit_linear, tolerance=args.fit))
+
+
+def single_pass(args: CommonParser) -> bool:
+    "Whether to generate while extracting, instead of going through datas/."
+    return not args.only_generate and not args.two_pass
+
+
 def pixels(orig_args: CLIParser):
-    from frames2osb.pixels import osb, pixel_extract
+    from frames2osb.pixels import fused, osb, pixel_extract
 
     args = cast(PixelParser, orig_args)
+    factor = decimation(args.fps, args.rate)
+    if single_pass(args):
+        print("> Extracting pixel data and generating osb")
+        setup_writer(args)
+        with profiling.stage("single_pass"):
+            if args.stream:
+                frames, total_frames = video_frames(args, args.size, factor)
+                fused.run_stream(
+                    frames,
+                    total_frames,
+                    args.size,
+                    args.outfile,
+                    use_rgb=args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    threshold=args.threshold,
+                    fps=args.fps / factor,
+                    precision=args.precision,
+                    music_offset=args.offset,
+                    static_threshold=args.static_threshold,
+                )
+            else:
+                fused.run(
+                    args.size,
+                    args.outfile,
+                    use_rgb=args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    cache=frame_cache(args),
+                    threshold=args.threshold,
+                    fps=args.fps / factor,
+                    precision=args.precision,
+                    music_offset=args.offset,
+                    stack=frame_stack(args, args.size),
+                    static_threshold=args.static_threshold,
+                    factor=factor,
+                )
+        return
+
     if not args.only_generate:
         print("> Extracting pixel data")
-        pixel_extract.run(
-            args.size,
-            args.use_rgb,
-            number_of_thread=args.jobs,
-            number_of_splits=args.splits,
-        )
+        with profiling.stage("extraction"):
+            if args.stream:
+                frames, total_frames = video_frames(args, args.size, factor)
+                pixel_extract.run_stream(
+                    frames,
+                    total_frames,
+                    args.size,
+                    args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    threshold=args.threshold,
+                    static_threshold=args.static_threshold,
+                )
+            else:
+                pixel_extract.run(
+                    args.size,
+                    args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    cache=frame_cache(args),
+                    threshold=args.threshold,
+                    stack=frame_stack(args, args.size),
+                    static_threshold=args.static_threshold,
+                    factor=factor,
+                )
 
     print("> Generating osb")
-    osb.generate_osb(
-        args.size,
-        args.outfile,
-        fps=args.fps,
-        precision=args.precision,
-        use_rgb=args.use_rgb,
-        music_offset=args.offset,
-    )
+    with profiling.stage("generation"):
+        setup_writer(args)
+        osb.generate_osb(
+            args.size,
+            args.outfile,
+            fps=args.fps / factor,
+            precision=args.precision,
+            use_rgb=args.use_rgb,
+            music_offset=args.offset,
+            number_of_jobs=args.jobs,
+        )
 
 
 def quadtree(orig_args: CLIParser):
-    from frames2osb.quadtree import osb, pixel_extract
+    from frames2osb.quadtree import fused, osb, pixel_extract
+    from frames2osb.quadtree.typings import Subdivision
 
     args = cast(QuadTreeParser, orig_args)
+    if args.temporal and args.max_error <= 0:
+        # Leaves only stick around while within max_error / 2 of the last frame.
+        args.error("--temporal requires --max_error")
+
+    subdivision = None
+    if args.max_error or args.max_leaves or args.temporal:
+        subdivision = Subdivision(args.max_error, args.max_leaves, args.temporal)
+    factor = decimation(args.fps, args.rate)
+
+    if single_pass(args):
+        print("> Extracting pixel data and generating osb")
+        setup_writer(args)
+        with profiling.stage("single_pass"):
+            if args.stream:
+                frames, total_frames = video_frames(args, 1, factor)
+                fused.run_stream(
+                    frames,
+                    total_frames,
+                    args.quality,
+                    args.outfile,
+                    use_rgb=args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    subdivision=subdivision,
+                    fps=args.fps / factor,
+                    precision=args.precision,
+                    music_offset=args.offset,
+                    static_threshold=args.static_threshold,
+                )
+            else:
+                fused.run(
+                    args.quality,
+                    args.outfile,
+                    use_rgb=args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    cache=frame_cache(args),
+                    subdivision=subdivision,
+                    fps=args.fps / factor,
+                    precision=args.precision,
+                    music_offset=args.offset,
+                    stack=frame_stack(args, 1),
+                    static_threshold=args.static_threshold,
+                    factor=factor,
+                )
+        return
+
     if not args.only_generate:
         print("> Extracting pixel data")
-        pixel_extract.run(
-            args.quality,
-            args.use_rgb,
-            number_of_thread=args.jobs,
-            number_of_splits=args.splits,
-        )
+        with profiling.stage("extraction"):
+            if args.stream:
+                frames, total_frames = video_frames(args, 1, factor)
+                pixel_extract.run_stream(
+                    frames,
+                    total_frames,
+                    args.quality,
+                    args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    subdivision=subdivision,
+                    static_threshold=args.static_threshold,
+                )
+            else:
+                pixel_extract.run(
+                    args.quality,
+                    args.use_rgb,
+                    number_of_thread=args.jobs,
+                    number_of_splits=args.splits,
+                    cache=frame_cache(args),
+                    subdivision=subdivision,
+                    stack=frame_stack(args, 1),
+                    static_threshold=args.static_threshold,
+                    factor=factor,
+                )
 
     print("> Generating osb")
-    osb.generate_osb(
-        args.quality,
-        args.outfile,
-        fps=args.fps,
-        precision=args.precision,
-        use_rgb=args.use_rgb,
-        music_offset=args.offset,
-    )
+    with profiling.stage("generation"):
+        setup_writer(args)
+        osb.generate_osb(
+            args.quality,
+            args.outfile,
+            fps=args.fps / factor,
+            precision=args.precision,
+            use_rgb=args.use_rgb,
+            music_offset=args.offset,
+            number_of_jobs=args.jobs,
+        )
 
 
 def main():
     args = CLIParser(prog="frames2osb").parse_args()
+    common = cast(CommonParser, args)
+    if common.cprofile and not common.profile:
+        args.error("--cprofile requires --profile")
+    if common.only_generate and not os.path.isdir("datas"):
+        # The default single pass generates straight from the extractor.
+        args.error("--only_generate needs datas/, extract with --two_pass first")
+    if common.profile:
+        profiling.start(common.cprofile)
 
-    if args.video:
-        fps = convert_video(args.video)
-        args.fps = fps
+    if args.stream:
+        if not args.video:
+            args.error("--stream requires --video")
+        if common.stack:
+            args.error("--stack needs frames/, it can't be used with --stream")
+
+        # Frames are decoded later on by the extractor, we only need to know the
+        # size and rate of the video here.
+        video_stream = open_video(args.video)
+        set_source_size(video_stream["width"], video_stream["height"])
+        args.fps = get_fps(video_stream)
+        args.total_frames = count_frames(video_stream)
+    else:
+        if args.video:
+            with profiling.stage("conversion"):
+                fps = convert_video(args.video)
+            args.fps = fps
+
+        # Nothing is read from frames/ until the extractor needs it, and the listing
+        # is cached for the next run.
+        set_frame_source(FrameSource("frames"))
 
     if args.method == "pixels":
         pixels(args)
@@ -138,3 +380,7 @@ def main():
         quadtree(args)
     else:
         args.print_help()
+
+    if common.profile:
+        profiling.report(common.profile)
+        print(f"> Profile written to {common.profile}")
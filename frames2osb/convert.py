@@ -1,13 +1,33 @@
 import json
+import math
 import os
 import shutil
 import subprocess
 import sys
 from pathlib import Path
-from typing import List, Literal, Optional, TypedDict, Union
+from typing import Iterator, List, Literal, Optional, TypedDict, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb import profiling
 
 FFPROBE_CMD = 'ffprobe -v quiet -print_format json -show_format -show_streams "{0}"'
 FFMPEG_CMD = 'ffmpeg -i "{0}" frames/%03d.jpg'
+FFMPEG_STREAM_CMD = [
+    "ffmpeg",
+    "-v",
+    "quiet",
+    "-i",
+    "{0}",
+    "-vf",
+    "scale={1}:{2}",
+    "-f",
+    "rawvideo",
+    "-pix_fmt",
+    "{3}",
+    "-",
+]
 
 
 # Minimum typing just to get it done
@@ -18,6 +38,9 @@ class Stream(TypedDict):
     r_frame_rate: str
     duration: str
     bit_rate: str
+    width: int
+    height: int
+    nb_frames: str
 
 
 class Format(TypedDict):
@@ -55,13 +78,60 @@ def get_stream(path: Path) -> Stream:
     return video_stream
 
 
-def convert_video(video: str) -> float:
+def get_fps(video_stream: Stream) -> float:
+    # I would've used literal_eval if it actually works with division lol
+    fps: float = eval(video_stream["avg_frame_rate"])
+    return fps
+
+
+def count_frames(video_stream: Stream) -> int:
+    "Number of frames in the stream, estimated from its duration if ffprobe doesn't know."
+    if video_stream.get("nb_frames"):
+        return int(video_stream["nb_frames"])
+    return math.ceil(float(video_stream["duration"]) * get_fps(video_stream))
+
+
+def open_video(video: str) -> Stream:
     p = Path(video)
     if not p.exists():
         raise FileNotFoundError(f"File {p} does not exist.")
 
     print("> Getting video stream from file")
-    video_stream = get_stream(p)
+    return get_stream(p)
+
+
+def stream_frames(
+    video: str, width: int, height: int, use_rgb: bool = False
+) -> Iterator[NDArray[np.uint8]]:
+    """Decode the video with ffmpeg and yield each frame already scaled to width x height.
+
+    Frames are read as raw buffers from ffmpeg's stdout, so nothing is written to disk
+    and frames can be processed while ffmpeg is still decoding."""
+    pix_fmt = "rgb24" if use_rgb else "gray"
+    shape = (height, width, 3) if use_rgb else (height, width)
+    frame_size = math.prod(shape)
+
+    cmd = [
+        arg.format(Path(video).absolute().as_posix(), width, height, pix_fmt)
+        for arg in FFMPEG_STREAM_CMD
+    ]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        assert proc.stdout
+        while True:
+            # ffmpeg scales the frames too, so there is no resize stage here.
+            with profiling.stage("decode") as record:
+                buf = proc.stdout.read(frame_size)
+                record.frames += len(buf) // frame_size
+            if len(buf) < frame_size:
+                break
+            yield np.frombuffer(buf, dtype=np.uint8).reshape(shape)
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def convert_video(video: str) -> float:
+    video_stream = open_video(video)
 
     print("> Converting to frames")
     if Path("frames").exists():
@@ -80,8 +150,6 @@ def convert_video(video: str) -> float:
         pass
 
     os.makedirs("frames", exist_ok=True)
-    subprocess.run(FFMPEG_CMD.format(p.absolute().as_posix()), check=True)
+    subprocess.run(FFMPEG_CMD.format(Path(video).absolute().as_posix()), check=True)
 
-    # I would've used literal_eval if it actually works with division lol
-    fps: float = eval(video_stream["avg_frame_rate"])
-    return fps
+    return get_fps(video_stream)
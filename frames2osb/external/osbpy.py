@@ -29,12 +29,63 @@ and have rewritten parts of it to be more easily readable (hopefully)
 Original repository is available here:
 https://github.com/KawaiiWafu/osbpy
 """
+import heapq
 import os
-from typing import Iterable, List, Literal, Optional, Union
+import shutil
+import struct
+import tempfile
+from itertools import groupby
+from typing import Callable, Iterable, Iterator, List, Literal, Optional, Tuple, Union
 
 from frames2osb.external.typings import Layer, Loop, Origin, OsbEasing
 
 
+LAYERS: Tuple[Layer, ...] = ("Background", "Fail", "Pass", "Foreground")
+LAYER_HEADERS = (
+    "//Storyboard Layer 0 (Background)\n",
+    "//Storyboard Layer 1 (Fail)\n",
+    "//Storyboard Layer 2 (Pass)\n",
+    "//Storyboard Layer 3 (Foreground)\n",
+)
+
+# Spilled blocks are stored as (layer, object index, block size) followed by the block.
+SEGMENT_RECORD = struct.Struct("<BII")
+SegmentBlock = Tuple[int, int, int, bytes]
+
+
+def read_segment(path: str, segment: int) -> Iterator[SegmentBlock]:
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(SEGMENT_RECORD.size)
+            if not head:
+                return
+            layer, index, size = SEGMENT_RECORD.unpack(head)
+            yield layer, index, segment, f.read(size)
+
+
+def read_part_objects(path: str) -> Iterator[str]:
+    "Every object's lines in a part file, one object at a time."
+    block: List[str] = []
+    with open(path) as f:
+        for line in f:
+            # Only the line that starts an object isn't indented.
+            if block and not line.startswith(" "):
+                yield "".join(block)
+                block = []
+            block.append(line)
+    if block:
+        yield "".join(block)
+
+
+def _keyed_objects(
+    path: str, keys: Iterator[int], part: int
+) -> Iterator[Tuple[int, int, str]]:
+    # Objects are read before their key, so the keys of a part are only used up by
+    # its objects, layer after layer.
+    for block, key in zip(read_part_objects(path), keys):
+        yield key, part, block
+
+
 def check_path(path: str):
     if not isinstance(path, str):
         raise ValueError("{val} is an invalid path.".format(val=path))
@@ -138,6 +189,25 @@ class Osbject:
 
     _init = False
 
+    # Spilling: once more than _spill_limit commands are buffered, every object's
+    # commands are written to a segment file and dropped from memory. Segments are
+    # sorted by (layer, object), so end() only has to merge them. The folder they
+    # go in is made on the first spill, by the process that spills, and only that
+    # process removes it: forked workers inherit the parent's.
+    _spill_limit = 0
+    _spill_parent: Optional[str] = None
+    _spill_dir: Optional[str] = None
+    _spill_pid = 0
+    _segments: List[str] = []
+    _buffered = 0
+    _dirty: List["Osbject"] = []
+
+    # Every command ever added, whether it is still buffered or not.
+    commands_added = 0
+
+    # Passes run over each object's lines right before they are written.
+    _optimizers: List[Callable[[List[str]], List[str]]] = []
+
     def __init__(
         self,
         path: str,
@@ -149,6 +219,8 @@ class Osbject:
         frame_rate: Optional[int] = None,
         loop: Optional[Loop] = None,
     ):
+        self._layer = LAYERS.index(layer)
+        self._index = len(Osbject.obj_link[layer])
         Osbject.obj_link[layer].append(self)
         self.props: List[str] = []
         assert check_path(path) and check_layer(layer) and check_origin(origin)
@@ -193,8 +265,100 @@ class Osbject:
             return str(v)
 
         props_string = leading + ",".join(map(_convert, args))
+        if not self.props:
+            Osbject._dirty.append(self)
         self.props.append(props_string)
 
+        Osbject._buffered += 1
+        Osbject.commands_added += 1
+        if Osbject._spill_limit and Osbject._buffered >= Osbject._spill_limit:
+            Osbject.spill()
+
+    @classmethod
+    def _add_bulk(cls, objects: Iterable["Osbject"], lines: Iterable[str]):
+        added = 0
+        for obj, line in zip(objects, lines):
+            if not obj.props:
+                cls._dirty.append(obj)
+            obj.props.append(line)
+            added += 1
+        cls._buffered += added
+        cls.commands_added += added
+
+        if cls._spill_limit and cls._buffered >= cls._spill_limit:
+            cls.spill()
+
+    @classmethod
+    def fade_bulk(
+        cls,
+        objects: Iterable["Osbject"],
+        easing: OsbEasing,
+        times: Iterable[int],
+        values: Iterable[float],
+    ):
+        """Add an instantaneous fade to each object, at the matching time and value.
+
+        This is for generators that already know their values are valid, so nothing
+        is checked, and lines are formatted in one go instead of through add()."""
+        prefix = " F,{0},".format(int(easing))
+        cls._add_bulk(objects, [f"{prefix}{t},,{v}" for t, v in zip(times, values)])
+
+    @classmethod
+    def colour_bulk(
+        cls,
+        objects: Iterable["Osbject"],
+        easing: OsbEasing,
+        times: Iterable[int],
+        colours: Iterable[Iterable[int]],
+    ):
+        "Unchecked bulk version of colour(), see fade_bulk."
+        prefix = " C,{0},".format(int(easing))
+        cls._add_bulk(
+            objects,
+            [f"{prefix}{t},,{r},{g},{b}" for t, (r, g, b) in zip(times, colours)],
+        )
+
+    @classmethod
+    def add_optimizer(cls, optimizer: Callable[[List[str]], List[str]]):
+        "Rewrite every object's lines with optimizer when the storyboard is written."
+        cls._optimizers.append(optimizer)
+
+    @classmethod
+    def _optimize(cls, lines: List[str]) -> List[str]:
+        for optimizer in cls._optimizers:
+            lines = optimizer(lines)
+        return lines
+
+    @classmethod
+    def enable_spill(cls, max_buffered: int, directory: Optional[str] = None):
+        """Bound memory by spilling commands to disk every max_buffered commands.
+
+        0 disables it and keeps the whole storyboard in memory until end()."""
+        cls._spill_limit = max_buffered
+        cls._spill_parent = directory
+
+    @classmethod
+    def spill(cls):
+        if not cls._dirty:
+            return
+
+        if cls._spill_dir is None or cls._spill_pid != os.getpid():
+            cls._spill_dir = tempfile.mkdtemp(prefix="osb_", dir=cls._spill_parent)
+            cls._spill_pid = os.getpid()
+            cls._segments = []
+        path = os.path.join(cls._spill_dir, f"segment_{len(cls._segments)}.bin")
+        cls._dirty.sort(key=lambda obj: (obj._layer, obj._index))
+        with open(path, "wb") as f:
+            for obj in cls._dirty:
+                block = ("%s\n" % "\n".join(obj.props)).encode()
+                f.write(SEGMENT_RECORD.pack(obj._layer, obj._index, len(block)))
+                f.write(block)
+                obj.props = []
+
+        cls._segments.append(path)
+        cls._dirty = []
+        cls._buffered = 0
+
     def fade(
         self,
         easing: OsbEasing,
@@ -457,23 +621,124 @@ class Osbject:
         tag = "T"
         self.add((tag, trigger, start, loop_count))
 
+    @classmethod
+    def _iter_blocks(cls) -> Iterator[Tuple[int, str]]:
+        "Every object's lines, in layer and creation order, as (layer, block)."
+        if not cls._segments:
+            for layer, name in enumerate(LAYERS):
+                for val in cls.obj_link[name]:
+                    yield layer, "%s\n" % "\n".join(cls._optimize(val.props))
+            return
+
+        cls.spill()
+        blocks = heapq.merge(
+            *(read_segment(path, i) for i, path in enumerate(cls._segments))
+        )
+        for (layer, _), group in groupby(blocks, key=lambda b: b[:2]):
+            block = b"".join(b[3] for b in group).decode()
+            if cls._optimizers:
+                block = "%s\n" % "\n".join(cls._optimize(block[:-1].split("\n")))
+            yield layer, block
+
+    @classmethod
+    def _remove_spill(cls):
+        if cls._spill_dir and cls._spill_pid == os.getpid():
+            shutil.rmtree(cls._spill_dir, ignore_errors=True)
+        cls._spill_dir = None
+        cls._segments = []
+
+    @classmethod
+    def reset(cls):
+        "Forget every object, so a new storyboard can be built in the same process."
+        for objects in cls.obj_link.values():
+            objects.clear()
+        cls._dirty = []
+        cls._buffered = 0
+        cls._remove_spill()
+
+    @classmethod
+    def get_settings(cls) -> Tuple[int, List[Callable[[List[str]], List[str]]]]:
+        "Spill limit and optimizers, to set up the same writer in another process."
+        return cls._spill_limit, list(cls._optimizers)
+
+    @classmethod
+    def apply_settings(
+        cls, settings: Tuple[int, List[Callable[[List[str]], List[str]]]]
+    ):
+        spill_limit, optimizers = settings
+        cls._optimizers = optimizers
+        cls.reset()
+        cls.enable_spill(spill_limit)
+
+    @classmethod
+    def write_parts(cls, prefix: str) -> List[str]:
+        """Write the objects of each layer to its own file, without any headers.
+
+        Parts written by different processes can then be put together with join_parts.
+        """
+        paths = [f"{prefix}_{layer}.part" for layer in range(len(LAYERS))]
+        files = [open(path, "w") for path in paths]
+        try:
+            for layer, block in cls._iter_blocks():
+                files[layer].write(block)
+        finally:
+            for f in files:
+                f.close()
+
+        cls.reset()
+        return paths
+
+    @classmethod
+    def join_parts(
+        cls, osb_file, parts: List[List[str]], keys: Optional[List[List[int]]] = None
+    ):
+        """Write a storyboard out of write_parts' files, in the given order.
+
+        keys, if given, has a sort key for every object of each part, in the order
+        they were written. The objects of every layer are then merged by key instead,
+        which only works out if each part is already in key order."""
+        if os.path.isfile(osb_file):
+            os.remove(osb_file)
+
+        part_keys = [iter(k) for k in keys] if keys is not None else None
+        with open(osb_file, "a") as text:
+            text.write("[Events]\n//Background and Video events\n")
+            for layer, header in enumerate(LAYER_HEADERS):
+                text.write(header)
+                if part_keys is None:
+                    for part in parts:
+                        with open(part[layer]) as f:
+                            shutil.copyfileobj(f, text)
+                    continue
+
+                objects = heapq.merge(
+                    *(
+                        _keyed_objects(part[layer], k, i)
+                        for i, (part, k) in enumerate(zip(parts, part_keys))
+                    )
+                )
+                for _, _, block in objects:
+                    text.write(block)
+            text.write("//Storyboard Sound Samples\n")
+
+        cls._remove_spill()
+
     @classmethod
     def end(cls, osb_file):
         if os.path.isfile(osb_file):
             os.remove(osb_file)
+
         with open(osb_file, "a") as text:
-            text.write(
-                "[Events]\n//Background and Video events\n//Storyboard Layer 0 (Background)\n"
-            )
-            for val in cls.obj_background:
-                text.write("%s\n" % "\n".join(val.props))
-            text.write("//Storyboard Layer 1 (Fail)\n")
-            for val in cls.obj_fail:
-                text.write("%s\n" % "\n".join(val.props))
-            text.write("//Storyboard Layer 2 (Pass)\n")
-            for val in cls.obj_pass:
-                text.write("%s\n" % "\n".join(val.props))
-            text.write("//Storyboard Layer 3 (Foreground)\n")
-            for val in cls.obj_foreground:
-                text.write("%s\n" % "\n".join(val.props))
+            text.write("[Events]\n//Background and Video events\n")
+            layer = -1
+            for block_layer, block in cls._iter_blocks():
+                while layer < block_layer:
+                    layer += 1
+                    text.write(LAYER_HEADERS[layer])
+                text.write(block)
+
+            for header in LAYER_HEADERS[layer + 1 :]:  # noqa
+                text.write(header)
             text.write("//Storyboard Sound Samples\n")
+
+        cls._remove_spill()
@@ -1,15 +1,44 @@
+import json
 import math
 import os
 import shutil
 import sys
+import tempfile
 import warnings
+from contextlib import contextmanager
 from functools import cache
-from typing import List, Tuple, TypeVar, Generic
+from itertools import islice, repeat
+from collections import deque
+from multiprocessing import Manager
+from multiprocessing.connection import Connection
+from multiprocessing.pool import AsyncResult, Pool
+from queue import Queue
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
+import numpy as np
+from numpy.typing import NDArray
 from PIL import Image
 
+from frames2osb import profiling
+from frames2osb.external.osbpy import Osbject
+
 T = TypeVar("T")
 
+# Size of the source frames, when they don't come from the frames folder.
+_source_size: Optional[Tuple[int, int]] = None
+_frame_source: Optional["FrameSource"] = None
+
 
 def sort_datas(filename: str) -> int:
     return int(os.path.splitext(filename)[0].split("_")[1])
@@ -19,11 +48,149 @@ def sort_image_files(f1: str) -> int:
     return int(os.path.splitext(f1)[0])
 
 
+class FrameSource:
+    """Sorted frame files of a folder and their size, looked up only when needed.
+
+    Listing a folder of 100k frames takes a while, so both are kept in a sidecar
+    file next to the folder and reused for as long as the folder isn't modified.
+    Writing frames over existing ones doesn't modify the folder, so the size is only
+    reused while the first frame's file is unchanged too. If the folder is gone, e.g.
+    with --only_generate, the sidecar is used as is."""
+
+    def __init__(self, directory: str = "frames"):
+        self.directory = os.path.normpath(directory)
+        self.index_file = self.directory + "_index.json"
+        self._files: Optional[List[str]] = None
+        self._size: Optional[Tuple[int, int]] = None
+        self._index_read = False
+
+    def _modified(self) -> Optional[int]:
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _first_stat(self) -> Optional[List[int]]:
+        if not self._files:
+            return None
+        try:
+            stat = os.stat(self.path(self._files[0]))
+        except FileNotFoundError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _read_index(self):
+        if self._index_read:
+            return
+        self._index_read = True
+
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        modified = self._modified()
+        if modified is not None and index.get("modified") != modified:
+            return
+
+        self._files = index.get("files")
+        if modified is not None and index.get("first") != self._first_stat():
+            return
+        if index.get("size"):
+            width, height = index["size"]
+            self._size = (width, height)
+
+    def _write_index(self):
+        index = {
+            "modified": self._modified(),
+            "files": self._files,
+            "size": self._size,
+            "first": self._first_stat(),
+        }
+        try:
+            with open(self.index_file, "w") as f:
+                json.dump(index, f)
+        except OSError:
+            # Only a cache, the frames can still be listed next time.
+            pass
+
+    @property
+    def files(self) -> List[str]:
+        self._read_index()
+        if self._files is None:
+            files = os.listdir(self.directory)
+            files.sort(key=sort_image_files)
+            self._files = files
+            self._write_index()
+        return self._files
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        "Width and height of the frames, taken from the first one."
+        self._read_index()
+        if self._size is None:
+            with Image.open(self.path(self.files[0])) as im:
+                self._size = im.size
+            self._write_index()
+        return self._size
+
+    def path(self, image_file: str) -> str:
+        return os.path.join(self.directory, image_file)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+def open_frame(
+    path: str, width: int, height: int, use_rgb: bool = False
+) -> Image.Image:
+    """Decode a frame that is going to be resized to width x height.
+
+    JPEGs are decoded straight to the smallest 1/2, 1/4 or 1/8 scale that is still
+    at least width x height, and to grayscale unless use_rgb, which leaves the
+    resize with a fraction of the pixels. Other formats are decoded whole."""
+    im = Image.open(path)
+    im.draft("RGB" if use_rgb else "L", (width, height))
+    im.load()
+    return im
+
+
+def is_static(
+    image: NDArray[np.uint8], last: Optional[NDArray[np.uint8]], threshold: int
+) -> bool:
+    """Whether image is within threshold of last in every pixel and channel, so it
+    can be skipped as a repeat of it. A negative threshold never skips a frame."""
+    if last is None or threshold < 0:
+        return False
+    if threshold == 0:
+        return np.array_equal(image, last)
+    return int(np.abs(image.astype(np.int16) - last).max()) <= threshold
+
+
+def set_frame_source(source: FrameSource):
+    global _frame_source
+    _frame_source = source
+    get_max_resolution.cache_clear()
+
+
+def get_frame_source() -> FrameSource:
+    global _frame_source
+    if _frame_source is None:
+        _frame_source = FrameSource()
+    return _frame_source
+
+
+def set_source_size(width: int, height: int):
+    "Use this frame size instead of reading it from the frames folder."
+    global _source_size
+    _source_size = (width, height)
+    get_max_resolution.cache_clear()
+
+
 @cache
 def get_max_resolution(obj_size: int) -> Tuple[int, int, int]:
-    im_file = os.listdir("frames")[0]
-    with Image.open(os.path.join("frames", im_file)) as im:
-        x_original, y_original = im.size
+    x_original, y_original = _source_size or get_frame_source().size
 
     osb_scale = y_original / 480
     scaled_x = math.ceil(x_original / osb_scale)
@@ -37,6 +204,127 @@ def get_max_resolution(obj_size: int) -> Tuple[int, int, int]:
     return x_max, y_max, x_shift
 
 
+# Arguments of a partition, Osbject settings and the prefix of its part files.
+PartitionTask = Tuple[Tuple[Any, ...], Any, str]
+# Part files from Osbject.write_parts, and the sort key of every object in them if
+# they are to be merged by key, see Osbject.join_parts.
+PartFiles = Tuple[List[str], Optional[List[int]]]
+
+
+def generate_partitioned(
+    task: Callable[[PartitionTask], PartFiles],
+    partitions: List[Tuple[Any, ...]],
+    number_of_jobs: int,
+    output_filename: str,
+):
+    """Generate each partition of the storyboard in a process pool, then join them.
+
+    task gets a PartitionTask and returns its PartFiles. Parts are joined in the same
+    order as partitions, whatever order they finish in, or merged by their keys."""
+    settings = Osbject.get_settings()
+    with tempfile.TemporaryDirectory(prefix="parts_", dir=".") as directory:
+        tasks = [
+            (args, settings, os.path.join(directory, f"part_{i}"))
+            for i, args in enumerate(partitions)
+        ]
+
+        pbar = SimpleProgressBar(total=len(tasks))
+        parts: List[List[str]] = []
+        keys: List[List[int]] = []
+        with Pool(number_of_jobs) as pool:
+            for part, part_keys in pool.imap(task, tasks):
+                parts.append(part)
+                if part_keys is not None:
+                    keys.append(part_keys)
+                pbar.update(1)
+
+        with profiling.stage("write"):
+            Osbject.join_parts(output_filename, parts, keys if keys else None)
+
+
+def ordered_results(
+    pool: Pool, func: Callable[..., T], tasks: Iterable[Tuple[Any, ...]], window: int
+) -> Iterator[Tuple[Tuple[Any, ...], T]]:
+    """Run func on the arguments of every task in pool, and yield them with the
+    result, in the order tasks were given in.
+
+    Only window tasks are queued or running at a time, so neither the tasks nor
+    their results pile up when the caller is slower than the pool."""
+    pending: Deque[Tuple[Tuple[Any, ...], AsyncResult]] = deque()
+    for args in tasks:
+        pending.append((args, pool.apply_async(func, args)))
+        if len(pending) >= window:
+            args, result = pending.popleft()
+            yield args, result.get()
+
+    while pending:
+        args, result = pending.popleft()
+        yield args, result.get()
+
+
+@contextmanager
+def baseline_queues(
+    chained: bool,
+) -> Iterator[Iterator[Tuple[Optional[Queue], Optional[Queue]]]]:
+    """The baseline_in and baseline_out of every chunk, in chunk order.
+
+    When chained, a chunk depends on more than the frame before it, so the chunk
+    before it puts what it ended on into its baseline_in once it is done. Each chunk
+    then waits on the one before it, so chunks have to go to the pool in order."""
+    if not chained:
+        yield repeat((None, None))
+        return
+
+    with Manager() as manager:
+        # The manager drops a queue once nothing here refers to it anymore, which
+        # can be before its chunk even got to a worker.
+        made: List[Queue] = []
+
+        def queues() -> Iterator[Tuple[Optional[Queue], Optional[Queue]]]:
+            baseline_in: Optional[Queue] = None
+            while True:
+                baseline_out = manager.Queue()
+                made.append(baseline_out)
+                yield baseline_in, baseline_out
+                baseline_in = baseline_out
+
+        yield queues()
+
+
+def reset_datas(directory: str = "datas"):
+    try:
+        shutil.rmtree(directory)
+    except FileNotFoundError:
+        pass
+    os.makedirs(directory, exist_ok=True)
+
+
+def drain_progress(conn: Connection, pbar: "SimpleProgressBar", timeout: float = 0):
+    "Count every frame the workers reported done, waiting up to timeout for one."
+    while conn.poll(timeout):
+        conn.recv()
+        pbar.update(1)
+        timeout = 0
+
+
+def wait_results(
+    pending: Deque[AsyncResult],
+    conn: Connection,
+    pbar: "SimpleProgressBar",
+    limit: int = 0,
+):
+    """Show progress until at most limit chunks are still being processed.
+
+    A chunk that failed raises its exception here, instead of leaving the progress
+    bar waiting on frames that will never come."""
+    while len(pending) > limit:
+        if pending[0].ready():
+            pending.popleft().get()
+        else:
+            drain_progress(conn, pbar, 0.1)
+    drain_progress(conn, pbar)
+
+
 # https://stackoverflow.com/a/312464
 def chunks(lst: List[T], n: int):
     """Yield successive n-sized chunks from lst."""
@@ -44,6 +332,37 @@ def chunks(lst: List[T], n: int):
         yield lst[i : i + n]  # noqa
 
 
+def chunk_size(total: int, number_of_splits: int, factor: int = 1) -> int:
+    "Frames per chunk, a multiple of factor so no averaged window spans two chunks."
+    return max(1, total // (number_of_splits * factor)) * factor
+
+
+def average_frames(
+    frames: Iterable[NDArray[np.uint8]], factor: int = 1
+) -> Iterator[NDArray[np.uint8]]:
+    "Every factor frames averaged into one, the last one out of whatever is left."
+    if factor <= 1:
+        yield from frames
+        return
+
+    it = iter(frames)
+    while True:
+        window = list(islice(it, factor))
+        if not window:
+            return
+        yield np.mean(window, axis=0).round().astype(np.uint8)
+
+
+def decimation(fps: float, rate: float) -> int:
+    "How many source frames make one storyboard frame, to get about rate per second."
+    if rate <= 0 or rate >= fps:
+        return 1
+    factor = round(fps / rate)
+    if not math.isclose(fps / factor, rate):
+        warnings.warn(f"Storyboard rate is {fps / factor:g} instead of {rate:g}.")
+    return factor
+
+
 class SimpleProgressBar:
     def __init__(self, total: int):
         self.current = -1
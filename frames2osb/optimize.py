@@ -0,0 +1,117 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set
+
+# Passes here take one object's lines, as they are written into the .osb
+# (the Sprite line first, then its commands), and return new lines that look
+# the same in game. See Osbject.add_optimizer.
+
+
+class Command(NamedTuple):
+    line: int  # Line number within the object
+    time: int
+    tag: str
+    easing: str
+    values: str
+
+
+def _parse_instant_commands(lines: List[str]) -> Optional[Dict[str, List[Command]]]:
+    "Instantaneous commands of each type, or None if this object can't be touched."
+    commands: Dict[str, List[Command]] = {}
+    for i in range(1, len(lines)):
+        line = lines[i]
+        # Leave objects with loops or triggers alone, times in them are relative.
+        if line.startswith("  ") or line.startswith((" L,", " T,")):
+            return None
+
+        tag, easing, start, end, values = line[1:].split(",", 4)
+        if end or not start.lstrip("-").isdigit():
+            continue
+
+        cmds = commands.setdefault(tag, [])
+        time = int(start)
+        if cmds and cmds[-1].time > time:
+            return None
+        cmds.append(Command(i, time, tag, easing, values))
+    return commands
+
+
+def _values(cmd: Command) -> List[float]:
+    return [float(v) for v in cmd.values.split(",")]
+
+
+def _fits(
+    cmds: List[Command], values: List[List[float]], i: int, j: int, tolerance: float
+) -> bool:
+    "Whether a linear ramp from command i to command j passes every one in between."
+    start, end = cmds[i].time, cmds[j].time
+    if end <= start:
+        return False
+    first, last = values[i], values[j]
+    for k in range(i + 1, j):
+        position = (cmds[k].time - start) / (end - start)
+        for a, b, v in zip(first, last, values[k]):
+            if abs(a + (b - a) * position - v) > tolerance:
+                return False
+    return True
+
+
+def _monotonic(values: Sequence[List[float]]) -> bool:
+    for channel in zip(*values):
+        steps = [b - a for a, b in zip(channel, channel[1:])]
+        if any(d > 0 for d in steps) and any(d < 0 for d in steps):
+            return False
+    return True
+
+
+def fit_linear(
+    lines: List[str], tolerance: float = 0.05, min_run: int = 3
+) -> List[str]:
+    """Turn runs of gradually changing fades and colours into ranged commands.
+
+    A run of at least min_run instantaneous F or C commands whose values only go
+    one way becomes a single linear command from the first to the last one, if
+    the ramp is within tolerance of every command in between at its time. Colour
+    tolerance is scaled to 0-255. In between commands, the ramp moves on where the
+    steps held their value, which is what makes a fade look smooth anyway.
+
+    Types that already have ranged commands are left alone."""
+    commands = _parse_instant_commands(lines)
+    if not commands:
+        return lines
+
+    ranged = {line[1:].split(",", 1)[0] for line in lines[1:] if line.split(",", 4)[3]}
+    replaced: Dict[int, str] = {}
+    dropped: Set[int] = set()
+    for tag, cmds in commands.items():
+        if tag not in ("F", "C") or tag in ranged:
+            continue
+
+        limit = tolerance if tag == "F" else tolerance * 255
+        values = [_values(cmd) for cmd in cmds]
+        i = 0
+        while i < len(cmds):
+            # Every command of the run has to be linear, an eased one doesn't move
+            # like the ramp does.
+            j = i
+            while (
+                j + 1 < len(cmds)
+                and cmds[i].easing == cmds[j + 1].easing == "0"
+                and _monotonic(values[i : j + 2])  # noqa
+                and _fits(cmds, values, i, j + 1, limit)
+            ):
+                j += 1
+
+            if j - i + 1 < min_run:
+                i += 1
+                continue
+
+            first, last = cmds[i], cmds[j]
+            replaced[
+                first.line
+            ] = f" {tag},0,{first.time},{last.time},{first.values},{last.values}"
+            dropped.update(cmd.line for cmd in cmds[i + 1 : j + 1])  # noqa
+            i = j + 1
+
+    if not replaced:
+        return lines
+
+    return [replaced.get(i, line) for i, line in enumerate(lines) if i not in dropped]
@@ -0,0 +1,144 @@
+from itertools import islice
+from multiprocessing.pool import Pool
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb.cache import FrameCache
+from frames2osb.helper import (
+    SimpleProgressBar,
+    baseline_queues,
+    chunk_size,
+    chunks,
+    get_frame_source,
+    ordered_results,
+)
+from frames2osb.pixels.osb import generate_from_events
+from frames2osb.pixels.pixel_extract import extract_events, extract_frames
+from frames2osb.pixels.storage import ChangeEvents
+from frames2osb.stack import FrameStack
+
+# Single pass: workers extract chunks of frames while this process generates the
+# storyboard out of the chunks that are done, in frame order. Events go straight
+# from the workers to the generator, nothing is written to datas/.
+
+
+def _with_progress(
+    results: Iterable[Tuple[Tuple[Any, ...], ChangeEvents]], total: int
+) -> Iterator[ChangeEvents]:
+    pbar = SimpleProgressBar(total=total)
+    for args, events in results:
+        # Every task's first argument is its chunk of frames.
+        pbar.update(len(args[0]))
+        yield events
+
+
+def run(
+    obj_size: int,
+    output_filename: str,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    cache: Optional[FrameCache] = None,
+    threshold: int = 0,
+    fps: float = 30,
+    precision: int = 1,
+    music_offset: int = 0,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+):
+    all_image_files = get_frame_source().files
+    nchunk = chunk_size(len(all_image_files), number_of_splits, factor)
+
+    queues = baseline_queues(threshold > 0 or static_threshold > 0)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        tasks = (
+            (
+                arr,
+                obj_size,
+                nchunk * i // factor,
+                use_rgb,
+                all_image_files[max(0, nchunk * i - factor) : nchunk * i],  # noqa
+                cache,
+                threshold,
+                stack,
+                static_threshold,
+                factor,
+                baseline_in,
+                baseline_out,
+            )
+            for (i, arr), (baseline_in, baseline_out) in zip(
+                enumerate(chunks(all_image_files, nchunk)), baselines
+            )
+        )
+        # One chunk more than there are workers, so they are never idle while this
+        # process generates from the oldest one.
+        results = ordered_results(pool, extract_frames, tasks, number_of_thread + 1)
+        generate_from_events(
+            obj_size,
+            output_filename,
+            _with_progress(results, len(all_image_files)),
+            fps,
+            precision,
+            use_rgb,
+            music_offset,
+        )
+
+    if cache:
+        cache.evict()
+
+
+def run_stream(
+    frames: Iterator[NDArray[np.uint8]],
+    total_frames: int,
+    obj_size: int,
+    output_filename: str,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    threshold: int = 0,
+    fps: float = 30,
+    precision: int = 1,
+    music_offset: int = 0,
+    static_threshold: int = -1,
+):
+    "Same as run, but takes already resized frames as they are being decoded."
+    nchunk = max(1, total_frames // number_of_splits)
+
+    def tasks(baselines) -> Iterator[Tuple[Any, ...]]:
+        previous: Optional[NDArray[np.uint8]] = None
+        i = 0
+        while True:
+            arr = list(islice(frames, nchunk))
+            if not arr:
+                return
+            yield (
+                arr,
+                obj_size,
+                None,
+                nchunk * i,
+                use_rgb,
+                previous,
+                threshold,
+                static_threshold,
+                *next(baselines),
+            )
+            previous = arr[-1]
+            i += 1
+
+    queues = baseline_queues(threshold > 0 or static_threshold > 0)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        results = ordered_results(
+            pool, extract_events, tasks(baselines), number_of_thread + 1
+        )
+        generate_from_events(
+            obj_size,
+            output_filename,
+            _with_progress(results, total_frames),
+            fps,
+            precision,
+            use_rgb,
+            music_offset,
+        )
@@ -1,20 +1,41 @@
 import os
-import pickle
-from typing import Tuple
+from typing import Iterable, Iterator, List, Optional
 
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb import profiling
 from frames2osb.external.osbpy import Osbject
 from frames2osb.external.typings import OsbEasing
-from frames2osb.helper import ListProgressBar, get_max_resolution, sort_datas
-from frames2osb.pixels.typings import PixelData, PixelValue
+from frames2osb.helper import (
+    ListProgressBar,
+    PartFiles,
+    PartitionTask,
+    generate_partitioned,
+    get_max_resolution,
+    sort_datas,
+)
+from frames2osb.pixels.storage import (
+    ChangeEvents,
+    convert_legacy_datas,
+    list_data_files,
+    read_events,
+    unpack_rgb,
+)
+from frames2osb.pixels.typings import PixelValue
 
 
-def generate_pixels(obj_size: int) -> PixelValue[Osbject]:
+def generate_pixels(
+    obj_size: int, columns: Optional[range] = None
+) -> PixelValue[Osbject]:
     "Generate pixels for storyboard, represented with a square every obj_size-px"
     x_max, y_max, x_shift = get_max_resolution(obj_size)
     obj_offset = obj_size // 2
+    if columns is None:
+        columns = range(x_max)
 
     pixels: PixelValue[Osbject] = []
-    for x in range(x_max):
+    for x in columns:
         pixels.append([])
         for y in range(y_max):
             obj = Osbject(
@@ -25,117 +46,241 @@ def generate_pixels(obj_size: int) -> PixelValue[Osbject]:
                 obj_offset + y * obj_size,
             )
             obj.scale(OsbEasing.NoEasing, -1, -1, 1, obj_size)
-            pixels[x].append(obj)
+            pixels[-1].append(obj)
     return pixels
 
 
+def _first_of_cell(cell: NDArray[np.uint32]) -> NDArray[np.bool_]:
+    first = np.ones(len(cell), dtype=np.bool_)
+    first[1:] = cell[1:] != cell[:-1]
+    return first
+
+
+def _last_of_cell(cell: NDArray[np.uint32]) -> NDArray[np.bool_]:
+    last = np.ones(len(cell), dtype=np.bool_)
+    last[:-1] = cell[1:] != cell[:-1]
+    return last
+
+
+def _sorted_events(events: ChangeEvents) -> ChangeEvents:
+    # Events are stored frame by frame. A stable sort on the cell groups them per pixel
+    # while keeping every pixel's events in frame order.
+    order = np.argsort(events.cell, kind="stable")
+    return ChangeEvents(events.cell[order], events.offset[order], events.value[order])
+
+
+def _load_events(data_file: str, cells: range) -> ChangeEvents:
+    "Events of the given cells, numbered from the first one and sorted per pixel."
+    events = read_events(os.path.join("datas", data_file))
+    if cells.start or cells.stop <= events.cell.max(initial=0):
+        inside = (events.cell >= cells.start) & (events.cell < cells.stop)
+        events = ChangeEvents(
+            events.cell[inside] - np.uint32(cells.start),
+            events.offset[inside],
+            events.value[inside],
+        )
+    return _sorted_events(events)
+
+
+def _start_offsets(
+    offsets: NDArray[np.uint32], fps: float, music_offset: int
+) -> List[int]:
+    # offset here technically isn't offset in miliseconds, it is n-frame from start.
+    # So we use 1000 / fps.
+    return (
+        (music_offset + np.rint(offsets.astype(np.float64) * 1000 / fps))
+        .astype(np.int64)
+        .tolist()
+    )
+
+
 def _run_rgb(
     obj_size: int,
-    output_filename,
+    columns: range,
+    chunks: Iterable[ChangeEvents],
     fps: float = 30,
-    precision: int = 1,
-    use_rgb: bool = False,
     music_offset: int = 0,
 ):
-    data_files = os.listdir("datas")
-    data_files.sort(key=sort_datas)
-    pixels = generate_pixels(obj_size)
-    x_max, y_max, _ = get_max_resolution(obj_size)
+    pixels = [obj for column in generate_pixels(obj_size, columns) for obj in column]
 
-    last_pixel_data: PixelValue[Tuple[int, int, int]] = []
-    for x in range(x_max):
-        last_pixel_data.append([])
-        for y in range(y_max):
-            last_pixel_data[x].append((-255, -255, -255))
-
-    for data_file in ListProgressBar(data_files):
-        with open(os.path.join("datas", data_file), "rb") as f:
-            pixel_data: PixelData = pickle.load(f)
-
-        for x in range(x_max):
-            for y in range(y_max):
-                for p in pixel_data[x][y]:
-                    # Assert to ensure RGB is not None
-                    # ...and to make mypy happy.
-                    assert p.rgb
-
-                    # offset here technically isn't offset in miliseconds, it is n-frame from start.
-                    # So we use 1000 / fps.
-                    start_offset = music_offset + round(p.offset * 1000 / fps)
-
-                    # TODO: Precision configurator
-                    #       Maybe check if a pixel hasnt changed by like x values? idk
-
-                    # Only do another command if current alpha is different from last alpha.
-                    # This is to avoid duplicate command and save more space.
-                    if last_pixel_data[x][y] != p.rgb:
-                        pixels[x][y].colour(
-                            OsbEasing.NoEasing,
-                            start_offset,
-                            start_offset,
-                            *p.rgb,
-                            *p.rgb
-                        )
-                        last_pixel_data[x][y] = p.rgb
+    last_pixel_data: NDArray[np.int64] = np.full(len(pixels), -1, dtype=np.int64)
 
-        # Delete pixel data from memory to save memory because we don't use it anymore.
-        del pixel_data
+    for events in chunks:
+        if not len(events.cell):
+            continue
 
-    Osbject.end(output_filename)
+        with profiling.stage("generate") as record:
+            commands = Osbject.commands_added
+            # Only do another command if current colour is different from last colour.
+            # This is to avoid duplicate command and save more space.
+            # The previous colour of an event is the one before it, or the last one we
+            # emitted if it's the first event of that pixel in this file.
+            value = events.value.astype(np.int64)
+            previous = np.empty_like(value)
+            previous[1:] = value[:-1]
+            first = _first_of_cell(events.cell)
+            previous[first] = last_pixel_data[events.cell[first]]
+            keep = value != previous
 
+            last = _last_of_cell(events.cell)
+            last_pixel_data[events.cell[last]] = value[last]
 
-def generate_osb(
+            Osbject.colour_bulk(
+                [pixels[cell] for cell in events.cell[keep].tolist()],
+                OsbEasing.NoEasing,
+                _start_offsets(events.offset[keep], fps, music_offset),
+                unpack_rgb(events.value[keep]).tolist(),
+            )
+            record.events += len(events.cell)
+            record.commands += Osbject.commands_added - commands
+
+        # Delete pixel data from memory to save memory because we don't use it anymore.
+        del events
+
+
+def _run_alpha(
     obj_size: int,
-    output_filename,
+    columns: range,
+    chunks: Iterable[ChangeEvents],
     fps: float = 30,
     precision: int = 1,
-    use_rgb: bool = False,
     music_offset: int = 0,
 ):
-    if use_rgb:
-        return _run_rgb(obj_size, output_filename, fps, precision, True, music_offset)
+    pixels = [obj for column in generate_pixels(obj_size, columns) for obj in column]
 
-    data_files = os.listdir("datas")
-    data_files.sort(key=sort_datas)
-    pixels = generate_pixels(obj_size)
-    x_max, y_max, _ = get_max_resolution(obj_size)
+    # Every alpha value is rounded the same way, so do it once for all 256 of them.
+    alpha_table = np.array([round(a / 255, precision) for a in range(256)])
 
     # Prepare to save last alpha data before next data file is being loaded
     # This is because it is possible that next alpha data has the same alpha value as current one.
     # Therefore by remembering last alpha data we can avoid duplicate commands.
-    # Also I know I can use list comprehension, but I'd rather have people be able to
-    # read the code tbh.
-    last_alpha_data: PixelValue[float] = []
-    for x in range(x_max):
-        last_alpha_data.append([])
-        for y in range(y_max):
-            last_alpha_data[x].append(-1)
-
-    for data_file in ListProgressBar(data_files):
-        with open(os.path.join("datas", data_file), "rb") as f:
-            pixel_data: PixelData = pickle.load(f)
-
-        for x in range(x_max):
-            for y in range(y_max):
-                for p in pixel_data[x][y]:
-                    # Assert to ensure Alpha is not None
-                    # ...and to make mypy happy.
-                    assert p.alpha is not None
-
-                    # offset here technically isn't offset in miliseconds, it is n-frame from start.
-                    # So we use 1000 / fps.
-                    start_offset = music_offset + round(p.offset * 1000 / fps)
-                    alpha = round(p.alpha / 255, precision)
-
-                    # Only do another command if current alpha is different from last alpha.
-                    # This is to avoid duplicate command and save more space.
-                    if last_alpha_data[x][y] != alpha:
-                        pixels[x][y].fade(
-                            OsbEasing.NoEasing, start_offset, start_offset, alpha, alpha
-                        )
-                        last_alpha_data[x][y] = alpha
+    last_alpha_data: NDArray[np.float64] = np.full(len(pixels), -1.0)
+
+    for events in chunks:
+        if not len(events.cell):
+            continue
+
+        with profiling.stage("generate") as record:
+            commands = Osbject.commands_added
+            # Only do another command if current alpha is different from last alpha.
+            # This is to avoid duplicate command and save more space.
+            # The previous alpha of an event is the one before it, or the last one we
+            # emitted if it's the first event of that pixel in this file.
+            alpha = alpha_table[events.value]
+            previous = np.empty_like(alpha)
+            previous[1:] = alpha[:-1]
+            first = _first_of_cell(events.cell)
+            previous[first] = last_alpha_data[events.cell[first]]
+            keep = alpha != previous
+
+            last = _last_of_cell(events.cell)
+            last_alpha_data[events.cell[last]] = alpha[last]
+
+            Osbject.fade_bulk(
+                [pixels[cell] for cell in events.cell[keep].tolist()],
+                OsbEasing.NoEasing,
+                _start_offsets(events.offset[keep], fps, music_offset),
+                alpha[keep].tolist(),
+            )
+            record.events += len(events.cell)
+            record.commands += Osbject.commands_added - commands
 
         # Delete pixel data from memory to save memory because we don't use it anymore.
-        del pixel_data
+        del events
+
+
+def _read_datas(
+    obj_size: int, columns: range, show_progress: bool = True
+) -> Iterator[ChangeEvents]:
+    "Events of the given columns' pixels, data file by data file."
+    _, y_max, _ = get_max_resolution(obj_size)
+    data_files = list_data_files("datas")
+    data_files.sort(key=sort_datas)
+    cells = range(columns.start * y_max, columns.stop * y_max)
+
+    for data_file in ListProgressBar(data_files) if show_progress else data_files:
+        with profiling.stage("load") as record:
+            events = _load_events(data_file, cells)
+            record.events += len(events.cell)
+        yield events
+
+
+def _generate_columns(
+    obj_size: int,
+    columns: range,
+    chunks: Iterable[ChangeEvents],
+    fps: float,
+    precision: int,
+    use_rgb: bool,
+    music_offset: int,
+):
+    if use_rgb:
+        _run_rgb(obj_size, columns, chunks, fps, music_offset)
+    else:
+        _run_alpha(obj_size, columns, chunks, fps, precision, music_offset)
+
+
+@profiling.worker
+def _generate_part(task: PartitionTask) -> PartFiles:
+    (obj_size, columns, *settings), osb_settings, prefix = task
+    Osbject.apply_settings(osb_settings)
+    chunks = _read_datas(obj_size, columns, show_progress=False)
+    _generate_columns(obj_size, columns, chunks, *settings)
+    with profiling.stage("write"):
+        return Osbject.write_parts(prefix), None
+
+
+def generate_from_events(
+    obj_size: int,
+    output_filename: str,
+    chunks: Iterable[ChangeEvents],
+    fps: float = 30,
+    precision: int = 1,
+    use_rgb: bool = False,
+    music_offset: int = 0,
+):
+    """Like generate_osb, but from the events of every chunk instead of datas/.
+
+    Chunks have to come in frame order, each with the events of every pixel."""
+    x_max, _, _ = get_max_resolution(obj_size)
+    sorted_chunks = (_sorted_events(events) for events in chunks)
+    _generate_columns(
+        obj_size, range(x_max), sorted_chunks, fps, precision, use_rgb, music_offset
+    )
+    with profiling.stage("write"):
+        Osbject.end(output_filename)
+
+
+def generate_osb(
+    obj_size: int,
+    output_filename,
+    fps: float = 30,
+    precision: int = 1,
+    use_rgb: bool = False,
+    music_offset: int = 0,
+    number_of_jobs: int = 1,
+):
+    # Older runs stored pickled Points, move them to the columnar format first.
+    convert_legacy_datas("datas")
+    x_max, _, _ = get_max_resolution(obj_size)
+
+    if number_of_jobs <= 1:
+        columns = range(x_max)
+        chunks = _read_datas(obj_size, columns)
+        _generate_columns(
+            obj_size, columns, chunks, fps, precision, use_rgb, music_offset
+        )
+        with profiling.stage("write"):
+            Osbject.end(output_filename)
+        return
 
-    Osbject.end(output_filename)
+    # Every pixel has its own state, so columns of pixels can be generated by separate
+    # processes. Pixels are created column by column, so joining the parts in column
+    # order gives the exact same storyboard as doing it all at once.
+    bounds = np.linspace(0, x_max, number_of_jobs + 1).astype(int)
+    partitions = [
+        (obj_size, range(int(start), int(end)), fps, precision, use_rgb, music_offset)
+        for start, end in zip(bounds[:-1], bounds[1:])
+        if start < end
+    ]
+    generate_partitioned(_generate_part, partitions, number_of_jobs, output_filename)
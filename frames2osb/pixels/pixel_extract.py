@@ -1,98 +1,423 @@
-import os
-import pickle
-import shutil
-from multiprocessing.pool import ThreadPool
-from typing import List
+import math
+from collections import deque
+from itertools import islice
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+from multiprocessing.pool import AsyncResult, Pool
+from queue import Queue
+from typing import Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from PIL import Image
+import numpy as np
+from numpy.typing import NDArray
 
+from frames2osb import profiling
+from frames2osb.cache import FrameCache
 from frames2osb.helper import (
     SimpleProgressBar,
     chunks,
+    get_frame_source,
+    average_frames,
+    baseline_queues,
+    chunk_size,
     get_max_resolution,
-    sort_image_files,
+    is_static,
+    open_frame,
+    reset_datas,
+    wait_results,
 )
-from frames2osb.pixels.typings import PixelData, Point
+from frames2osb.pixels.storage import (
+    DATA_EXTENSION,
+    ChangeEvents,
+    concat_events,
+    pack_rgb,
+    write_events,
+)
+from frames2osb.stack import FrameStack
+
+
+def load_frame(
+    image_file: str,
+    x_max: int,
+    y_max: int,
+    use_rgb: bool = False,
+    cache: Optional[FrameCache] = None,
+) -> NDArray[np.uint8]:
+    path = get_frame_source().path(image_file)
+    with profiling.stage("decode") as record:
+        record.frames += 1
+        if cache:
+            # The resized frame is all there is to cache, diffing it again is cheap.
+            key = cache.key(path, "pixels", x_max, y_max, use_rgb)
+            data = cache.get(key)
+            if data is not None:
+                shape = (y_max, x_max, 3) if use_rgb else (y_max, x_max)
+                return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+        im = open_frame(path, x_max, y_max, use_rgb)
+
+    with im, profiling.stage("resize"):
+        im_resized = im.resize((x_max, y_max))
+
+        if use_rgb:
+            image = im_resized
+        else:
+            image = im_resized.convert("L")
+
+        frame = np.asarray(image)
+        if cache:
+            cache.put(key, frame.tobytes())
+    return frame
+
+
+@profiling.worker
+def extract_events(
+    frames: Iterable[NDArray[np.uint8]],
+    obj_size: int,
+    pipe: Optional[Connection] = None,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    previous: Optional[NDArray[np.uint8]] = None,
+    threshold: int = 0,
+    static_threshold: int = -1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> ChangeEvents:
+    """Extract change events from frames that are already resized to the pixel grid.
+
+    previous is the frame right before this chunk, if any. Without it every cell
+    gets an event on the chunk's first frame, whether it changed or not.
 
-all_image_files = os.listdir("frames")
-all_image_files.sort(key=sort_image_files)
+    A cell only gets an event when it differs from its last stored value by more
+    than threshold, in any channel. A frame within static_threshold of the last
+    frame that wasn't skipped is skipped as a whole, see helper.is_static.
 
+    Both depend on more than the frame before the chunk, so with either of them,
+    the chunk before this one puts its Baseline into baseline_in once it is done,
+    and this one puts its own into baseline_out, see helper.baseline_queues."""
+    x_max, y_max, _ = get_max_resolution(obj_size)
+
+    events: List[ChangeEvents] = []
+    # Last stored value of every cell, and the last frame that wasn't skipped.
+    stored: Optional[NDArray[np.int16]] = None
+    if previous is not None:
+        stored = previous.swapaxes(0, 1).astype(np.int16)
+    kept = previous
+
+    if baseline_in is not None:
+        # Load every frame while the chunk before this one is still being diffed.
+        frames = list(frames)
+        stored, kept = baseline_in.get()
+
+    for i, image in enumerate(frames):
+        if is_static(image, kept, static_threshold):
+            if pipe:
+                pipe.send(1)
+            continue
+        kept = image
+
+        with profiling.stage("extract") as record:
+            # Frames are indexed as [y][x], swap them so cells are numbered x * y_max + y.
+            frame = image.swapaxes(0, 1)
+
+            # Only add an entry if current value is different from last value.
+            # Thus we only have timestamps where the values are different.
+            # The whole frame is compared at once, then only the changed cells are stored.
+            if stored is None:
+                changed = np.ones((x_max, y_max), dtype=np.bool_)
+                stored = frame.astype(np.int16)
+            else:
+                # Comparing with the stored value rather than the previous frame means
+                # JPEG noise around a value never adds events, while a slow fade still
+                # does once it has moved far enough.
+                delta = np.abs(frame.astype(np.int16) - stored)
+                if use_rgb:
+                    delta = delta.max(axis=2)
+                changed = delta > threshold
+                stored[changed] = frame[changed]
+
+            xs, ys = np.nonzero(changed)
+            values = frame[xs, ys]
+            events.append(
+                ChangeEvents(
+                    (xs * y_max + ys).astype(np.uint32),
+                    np.full(len(xs), start_frame + i, dtype=np.uint32),
+                    pack_rgb(values) if use_rgb else values.astype(np.uint32),
+                )
+            )
+            record.frames += 1
+            record.events += len(xs)
+
+        if pipe:
+            pipe.send(1)
+
+    if baseline_out is not None:
+        baseline_out.put((stored, kept))
+    return concat_events(events)
+
+
+@profiling.worker
+def process_arrays(
+    frames: Iterable[NDArray[np.uint8]],
+    filename: str,
+    obj_size: int,
+    pipe: Connection,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    previous: Optional[NDArray[np.uint8]] = None,
+    threshold: int = 0,
+    static_threshold: int = -1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+):
+    "Extract change events from resized frames into filename, see extract_events."
+    events = extract_events(
+        frames,
+        obj_size,
+        pipe,
+        start_frame,
+        use_rgb,
+        previous,
+        threshold,
+        static_threshold,
+        baseline_in,
+        baseline_out,
+    )
 
+    # Parallel arrays are a lot smaller than pickled Points, and can be memory-mapped.
+    with profiling.stage("serialize") as record:
+        write_events(filename, events)
+        record.events += len(events.cell)
+
+
+def _load_chunk(
+    image_files: List[str],
+    obj_size: int,
+    start_frame: int,
+    use_rgb: bool,
+    previous_files: Sequence[str],
+    cache: Optional[FrameCache],
+    stack: Optional[FrameStack],
+    factor: int,
+) -> Tuple[Iterable[NDArray[np.uint8]], Optional[NDArray[np.uint8]]]:
+    """Frames of a chunk, loaded as they are needed, and the frame before them.
+
+    Every factor files are averaged into one frame, see helper.average_frames.
+    start_frame counts those, previous_files are the ones averaged into the frame
+    before the chunk."""
+    frames: Iterable[NDArray[np.uint8]]
+    previous_frames: Iterable[NDArray[np.uint8]]
+    if stack:
+        # The stack has every file, not every averaged frame.
+        start = start_frame * factor
+        frames = stack.slice(start, len(image_files))
+        previous_frames = stack.slice(start - len(previous_files), len(previous_files))
+    else:
+        x_max, y_max, _ = get_max_resolution(obj_size)
+        frames = (load_frame(f, x_max, y_max, use_rgb, cache) for f in image_files)
+        previous_frames = [
+            load_frame(f, x_max, y_max, use_rgb, cache) for f in previous_files
+        ]
+
+    previous = next(average_frames(previous_frames, factor), None)
+    return average_frames(frames, factor), previous
+
+
+@profiling.worker
 def process_frames(
     image_files: List[str],
     filename: str,
     obj_size: int,
-    bar: SimpleProgressBar,
+    pipe: Connection,
     start_frame: int = 0,
     use_rgb: bool = False,
+    previous_files: Sequence[str] = (),
+    cache: Optional[FrameCache] = None,
+    threshold: int = 0,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
 ):
-    x_max, y_max, _ = get_max_resolution(obj_size)
+    frames, previous = _load_chunk(
+        image_files,
+        obj_size,
+        start_frame,
+        use_rgb,
+        previous_files,
+        cache,
+        stack,
+        factor,
+    )
+    process_arrays(
+        frames,
+        filename,
+        obj_size,
+        pipe,
+        start_frame,
+        use_rgb,
+        previous,
+        threshold,
+        static_threshold,
+        baseline_in,
+        baseline_out,
+    )
 
-    # I know I can use list comprehension, but I'd rather have people be able to
-    # read the code tbh.
-    pixel_data: PixelData = []
-    for x in range(x_max):
-        pixel_data.append([])
-        for y in range(y_max):
-            pixel_data[x].append([])
 
-    for i in range(len(image_files)):
-        image_file = image_files[i]
-        with Image.open(os.path.join("frames", image_file)) as im:
-            im_resized = im.resize((x_max, y_max))
+@profiling.worker
+def extract_frames(
+    image_files: List[str],
+    obj_size: int,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    previous_files: Sequence[str] = (),
+    cache: Optional[FrameCache] = None,
+    threshold: int = 0,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> ChangeEvents:
+    "Like process_frames, but the events are returned instead of written to datas/."
+    frames, previous = _load_chunk(
+        image_files,
+        obj_size,
+        start_frame,
+        use_rgb,
+        previous_files,
+        cache,
+        stack,
+        factor,
+    )
+    return extract_events(
+        frames,
+        obj_size,
+        None,
+        start_frame,
+        use_rgb,
+        previous,
+        threshold,
+        static_threshold,
+        baseline_in,
+        baseline_out,
+    )
 
-        if use_rgb:
-            image = im_resized
-        else:
-            image = im_resized.convert("L")
 
-        for x in range(x_max):
-            for y in range(y_max):
-                px = pixel_data[x][y]
+# What a chunk hands over to the next one: the last stored value of every cell, and
+# the last frame that wasn't skipped. See extract_events.
+Baseline = Tuple[Optional[NDArray[np.int16]], Optional[NDArray[np.uint8]]]
 
-                # Only add an entry if current value is different from last value.
-                # Thus we only have timestamps where the values are different.
-                if use_rgb:
-                    current_rgb = image.getpixel((x, y))
-                    if not px or px[-1].rgb != current_rgb:
-                        pixel_data[x][y].append(
-                            Point(offset=start_frame + i, rgb=current_rgb)
-                        )
-                else:
-                    current_alpha = int(image.getpixel((x, y)))
-                    if not px or px[-1].alpha != current_alpha:
-                        pixel_data[x][y].append(
-                            Point(offset=start_frame + i, alpha=current_alpha)
-                        )
-
-        # Delete from memory to save space.
-        del im_resized
-        del image
-        bar.update(1)
-
-    # While using json is viable, pickle saves much more disk space and time.
-    with open(filename, "wb") as f:
-        pickle.dump(pixel_data, f)
-
-    # Delete from memory to save space.
-    del pixel_data
-
-
-def run(obj_size, use_rgb: bool = False, number_of_thread=2, number_of_splits=16):
-    try:
-        shutil.rmtree("datas")
-    except FileNotFoundError:
-        pass
-    os.makedirs("datas", exist_ok=True)
-
-    pbar = SimpleProgressBar(total=len(all_image_files))
-    with ThreadPool(number_of_thread) as pool:
-        nchunk = len(all_image_files) // number_of_splits
-        for i, arr in enumerate(chunks(all_image_files, nchunk)):
-            pool.apply_async(
-                process_frames,
-                args=(arr, f"datas/data_{i}.dat", obj_size, pbar, nchunk * i, use_rgb),
+
+def run(
+    obj_size,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    cache: Optional[FrameCache] = None,
+    threshold: int = 0,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+):
+    reset_datas()
+
+    all_image_files = get_frame_source().files
+
+    pbar = SimpleProgressBar(total=math.ceil(len(all_image_files) / factor))
+    queues = baseline_queues(threshold > 0 or static_threshold > 0)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        parent_conn, child_conn = Pipe()
+        nchunk = chunk_size(len(all_image_files), number_of_splits, factor)
+        pending: Deque[AsyncResult] = deque()
+        for (i, arr), (baseline_in, baseline_out) in zip(
+            enumerate(chunks(all_image_files, nchunk)), baselines
+        ):
+            # Chunks are diffed against the frame before them, so a chunk boundary
+            # doesn't turn into an event for every single cell.
+            start = nchunk * i
+            previous_files = all_image_files[max(0, start - factor) : start]  # noqa
+            pending.append(
+                pool.apply_async(
+                    process_frames,
+                    args=(
+                        arr,
+                        f"datas/data_{i}{DATA_EXTENSION}",
+                        obj_size,
+                        child_conn,
+                        start // factor,
+                        use_rgb,
+                        previous_files,
+                        cache,
+                        threshold,
+                        stack,
+                        static_threshold,
+                        factor,
+                        baseline_in,
+                        baseline_out,
+                    ),
+                )
             )
 
         pool.close()
+        wait_results(pending, parent_conn, pbar)
+        pool.join()
+
+    if cache:
+        cache.evict()
+
+
+def run_stream(
+    frames: Iterator[NDArray[np.uint8]],
+    total_frames: int,
+    obj_size,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    threshold: int = 0,
+    static_threshold: int = -1,
+):
+    "Same as run, but takes already resized frames as they are being decoded."
+    reset_datas()
+
+    pbar = SimpleProgressBar(total=total_frames)
+    queues = baseline_queues(threshold > 0 or static_threshold > 0)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        parent_conn, child_conn = Pipe()
+        nchunk = max(1, total_frames // number_of_splits)
+        pending: Deque[AsyncResult] = deque()
+        previous: Optional[NDArray[np.uint8]] = None
+        i = 0
+        while True:
+            arr = list(islice(frames, nchunk))
+            if not arr:
+                break
+
+            baseline_in, baseline_out = next(baselines)
+            pending.append(
+                pool.apply_async(
+                    process_arrays,
+                    args=(
+                        arr,
+                        f"datas/data_{i}{DATA_EXTENSION}",
+                        obj_size,
+                        child_conn,
+                        nchunk * i,
+                        use_rgb,
+                        previous,
+                        threshold,
+                        static_threshold,
+                        baseline_in,
+                        baseline_out,
+                    ),
+                )
+            )
+            previous = arr[-1]
+            i += 1
+
+            # Don't decode too far ahead of the workers, or every frame ends up in memory.
+            wait_results(pending, parent_conn, pbar, number_of_thread)
+
+        pool.close()
+        wait_results(pending, parent_conn, pbar)
         pool.join()
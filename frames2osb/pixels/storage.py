@@ -0,0 +1,109 @@
+import os
+import pickle
+from typing import List, NamedTuple, cast
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb.pixels.typings import PixelData
+
+DATA_EXTENSION = ".npy"
+LEGACY_EXTENSION = ".dat"
+
+EventArray = NDArray[np.uint32]
+
+
+class ChangeEvents(NamedTuple):
+    """Parallel arrays of change events, one entry per changed cell per frame.
+
+    cell is x * y_max + y, offset is the frame number and value is either
+    the alpha value or an RGB value packed as 0xRRGGBB."""
+
+    cell: EventArray
+    offset: EventArray
+    value: EventArray
+
+
+def pack_rgb(rgb: NDArray[np.uint8]) -> EventArray:
+    rgb32 = rgb.astype(np.uint32)
+    # numpy's stubs widen shifts by a Python int to a signed type, the values are not.
+    return cast(
+        EventArray, (rgb32[..., 0] << 16) | (rgb32[..., 1] << 8) | rgb32[..., 2]
+    )
+
+
+def unpack_rgb(value: EventArray) -> NDArray[np.uint32]:
+    return np.stack([(value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF], axis=-1)
+
+
+def concat_events(events: List[ChangeEvents]) -> ChangeEvents:
+    if not events:
+        empty = np.empty(0, dtype=np.uint32)
+        return ChangeEvents(empty, empty, empty)
+
+    return ChangeEvents(
+        np.concatenate([e.cell for e in events]).astype(np.uint32, copy=False),
+        np.concatenate([e.offset for e in events]).astype(np.uint32, copy=False),
+        np.concatenate([e.value for e in events]).astype(np.uint32, copy=False),
+    )
+
+
+def write_events(filename: str, events: ChangeEvents):
+    # Rows are stored one after another, so each column stays contiguous on disk
+    # and can be sliced straight out of the memory map.
+    np.save(filename, np.stack(events))
+
+
+def read_events(filename: str) -> ChangeEvents:
+    data = np.load(filename, mmap_mode="r")
+    return ChangeEvents(data[0], data[1], data[2])
+
+
+def legacy_to_events(pixel_data: PixelData) -> ChangeEvents:
+    "Convert the old pickled List[List[List[Point]]] into columnar events."
+    y_max = len(pixel_data[0]) if pixel_data else 0
+
+    cells: List[int] = []
+    offsets: List[int] = []
+    values: List[int] = []
+    for x, column in enumerate(pixel_data):
+        for y, points in enumerate(column):
+            for p in points:
+                cells.append(x * y_max + y)
+                offsets.append(p.offset)
+                if p.rgb is not None:
+                    r, g, b = p.rgb
+                    values.append((r << 16) | (g << 8) | b)
+                else:
+                    assert p.alpha is not None
+                    values.append(p.alpha)
+
+    return ChangeEvents(
+        np.array(cells, dtype=np.uint32),
+        np.array(offsets, dtype=np.uint32),
+        np.array(values, dtype=np.uint32),
+    )
+
+
+def convert_legacy_datas(directory: str = "datas"):
+    """Rewrite every legacy pickle chunk in directory to the columnar format.
+
+    The old file is removed afterwards so a chunk never gets read twice."""
+    for data_file in os.listdir(directory):
+        name, ext = os.path.splitext(data_file)
+        if ext != LEGACY_EXTENSION:
+            continue
+
+        legacy_path = os.path.join(directory, data_file)
+        with open(legacy_path, "rb") as f:
+            pixel_data: PixelData = pickle.load(f)
+
+        write_events(
+            os.path.join(directory, name + DATA_EXTENSION), legacy_to_events(pixel_data)
+        )
+        del pixel_data
+        os.remove(legacy_path)
+
+
+def list_data_files(directory: str = "datas") -> List[str]:
+    return [f for f in os.listdir(directory) if f.endswith(DATA_EXTENSION)]
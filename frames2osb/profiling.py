@@ -0,0 +1,206 @@
+import cProfile
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+# Profiling is switched on through the environment, so pool workers see it too,
+# whether they are forked or spawned. Every process appends what it measured to
+# its own file in PROFILE_ENV's directory, and report() sums them all up.
+PROFILE_ENV = "FRAMES2OSB_PROFILE"
+CPROFILE_ENV = "FRAMES2OSB_CPROFILE"
+
+STAGES = ["decode", "resize", "extract", "serialize", "load", "generate", "write"]
+PHASES = ["conversion", "stacking", "extraction", "generation", "single_pass"]
+STAT_KEYS = ["calls", "wall_s", "cpu_s", "frames", "events", "commands"]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class StageRecord:
+    "Counters a stage fills in while it runs."
+
+    def __init__(self):
+        self.frames = 0
+        self.events = 0
+        self.commands = 0
+
+
+_stats: Dict[str, Dict[str, float]] = {}
+_in_worker = False
+_main_profile: Optional[cProfile.Profile] = None
+
+
+def enabled() -> bool:
+    return PROFILE_ENV in os.environ
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageRecord]:
+    "Time the block as part of stage name, counters go into the yielded record."
+    record = StageRecord()
+    if not enabled():
+        yield record
+        return
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        stats = _stats.setdefault(name, dict.fromkeys(STAT_KEYS, 0))
+        stats["calls"] += 1
+        stats["wall_s"] += time.perf_counter() - wall
+        stats["cpu_s"] += time.process_time() - cpu
+        stats["frames"] += record.frames
+        stats["events"] += record.events
+        stats["commands"] += record.commands
+
+
+def flush(directory: Optional[str] = None):
+    "Append what this process measured so far to its file, and start over."
+    global _stats
+    directory = directory or os.environ.get(PROFILE_ENV)
+    if not directory or not _stats:
+        return
+
+    line = {"pid": os.getpid(), "peak_rss_kb": peak_rss_kb(), "stages": _stats}
+    with open(os.path.join(directory, f"{os.getpid()}.jsonl"), "a") as f:
+        f.write(json.dumps(line) + "\n")
+    _stats = {}
+
+
+def worker(func: F) -> F:
+    """Flush the stages of every call of a pool task, and with --cprofile, dump a
+    cProfile of it. Calls from inside another task are left alone."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _in_worker
+        if not enabled() or _in_worker:
+            return func(*args, **kwargs)
+
+        _in_worker = True
+        profile = cProfile.Profile() if CPROFILE_ENV in os.environ else None
+        try:
+            if profile:
+                profile.enable()
+            return func(*args, **kwargs)
+        finally:
+            if profile:
+                profile.disable()
+                fd, path = tempfile.mkstemp(
+                    prefix=f"{func.__name__}_{os.getpid()}_",
+                    suffix=".prof",
+                    dir=os.environ[CPROFILE_ENV],
+                )
+                os.close(fd)
+                profile.dump_stats(path)
+            flush()
+            _in_worker = False
+
+    return wrapper  # type: ignore
+
+
+def _stop_main_profile():
+    global _main_profile
+    if _main_profile:
+        _main_profile.disable()
+        _main_profile = None
+
+
+def _after_fork():
+    # A forked worker starts with a copy of what the main process measured so
+    # far, and would report it again, or keep adding to its profile.
+    global _stats
+    _stats = {}
+    _stop_main_profile()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def start(cprofile_dir: Optional[str] = None):
+    "Start profiling this process and every process it starts from now on."
+    global _main_profile
+    os.environ[PROFILE_ENV] = tempfile.mkdtemp(prefix="profile_")
+    if cprofile_dir:
+        os.makedirs(cprofile_dir, exist_ok=True)
+        os.environ[CPROFILE_ENV] = os.path.abspath(cprofile_dir)
+        _main_profile = cProfile.Profile()
+        _main_profile.enable()
+
+
+def _summarize(lines: List[Dict[str, Any]], names: List[str]) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {}
+    for name in names:
+        stats: Dict[str, Any] = {}
+        pids = set()
+        for line in lines:
+            if name not in line["stages"]:
+                continue
+            pids.add(line["pid"])
+            for key, value in line["stages"][name].items():
+                stats[key] = stats.get(key, 0) + value
+            if line["peak_rss_kb"] is not None:
+                stats["peak_rss_kb"] = max(
+                    stats.get("peak_rss_kb", 0), line["peak_rss_kb"]
+                )
+
+        if not stats:
+            continue
+        stats["wall_s"] = round(stats["wall_s"], 4)
+        stats["cpu_s"] = round(stats["cpu_s"], 4)
+        stats["processes"] = len(pids)
+        if stats["frames"] and stats["wall_s"]:
+            stats["fps"] = round(stats["frames"] / stats["wall_s"], 2)
+        summary[name] = stats
+    return summary
+
+
+def report(filename: str):
+    """Write every process' measurements to filename, as JSON, and stop profiling.
+
+    Stage times are summed over every process that ran them, so with several jobs
+    they add up to more than the phase they are part of."""
+    directory = os.environ.pop(PROFILE_ENV)
+    cprofile_dir = os.environ.pop(CPROFILE_ENV, None)
+    if _main_profile and cprofile_dir:
+        _main_profile.dump_stats(os.path.join(cprofile_dir, f"main_{os.getpid()}.prof"))
+        _stop_main_profile()
+    flush(directory)
+
+    lines: List[Dict[str, Any]] = []
+    for path in glob.glob(os.path.join(directory, "*.jsonl")):
+        with open(path) as f:
+            lines.extend(json.loads(line) for line in f)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    result: Dict[str, Any] = {
+        "phases": _summarize(lines, PHASES),
+        "stages": _summarize(lines, STAGES),
+        "processes": len({line["pid"] for line in lines}),
+        "peak_rss_kb": max((line["peak_rss_kb"] or 0 for line in lines), default=None),
+    }
+    if cprofile_dir:
+        result["cprofile"] = sorted(glob.glob(os.path.join(cprofile_dir, "*.prof")))
+
+    with open(filename, "w") as f:
+        json.dump(result, f, indent=2)
@@ -0,0 +1,152 @@
+from itertools import islice
+from multiprocessing.pool import Pool
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb.cache import FrameCache
+from frames2osb.helper import (
+    SimpleProgressBar,
+    baseline_queues,
+    chunk_size,
+    chunks,
+    get_frame_source,
+    get_max_resolution,
+    ordered_results,
+)
+from frames2osb.quadtree.osb import generate_from_frames
+from frames2osb.quadtree.pixel_extract import extract_arrays, extract_frames
+from frames2osb.quadtree.storage import QuadHeader
+from frames2osb.quadtree.typings import QuadFrame, Subdivision
+from frames2osb.stack import FrameStack
+
+# Single pass, see pixels.fused. Workers send back every frame of their chunk
+# with all of its leaves' means, so temporal frames need no decoding either.
+
+
+def _with_progress(
+    results: Iterable[Tuple[Tuple[Any, ...], List[QuadFrame]]],
+    header: QuadHeader,
+    total: int,
+) -> Iterator[Tuple[QuadHeader, List[QuadFrame]]]:
+    pbar = SimpleProgressBar(total=total)
+    for args, frames in results:
+        # Every task's first argument is its chunk of frames, some of which may
+        # have been skipped.
+        pbar.update(len(args[0]))
+        yield header, frames
+
+
+def _header(quality: int, use_rgb: bool) -> QuadHeader:
+    x_max, y_max, _ = get_max_resolution(1)
+    return QuadHeader(quality, 3 if use_rgb else 1, x_max, y_max)
+
+
+def run(
+    quality: int,
+    output_filename: str,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    cache: Optional[FrameCache] = None,
+    subdivision: Optional[Subdivision] = None,
+    fps: float = 30,
+    precision: int = 1,
+    music_offset: int = 0,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+):
+    all_image_files = get_frame_source().files
+    nchunk = chunk_size(len(all_image_files), number_of_splits, factor)
+
+    header = _header(quality, use_rgb)
+    temporal = subdivision is not None and subdivision.temporal
+    queues = baseline_queues(static_threshold > 0 or temporal)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        tasks = (
+            (
+                arr,
+                quality,
+                nchunk * i // factor,
+                use_rgb,
+                cache,
+                all_image_files[max(0, nchunk * i - factor) : nchunk * i],  # noqa
+                subdivision,
+                stack,
+                static_threshold,
+                factor,
+                baseline_in,
+                baseline_out,
+            )
+            for (i, arr), (baseline_in, baseline_out) in zip(
+                enumerate(chunks(all_image_files, nchunk)), baselines
+            )
+        )
+        results = ordered_results(pool, extract_frames, tasks, number_of_thread + 1)
+        generate_from_frames(
+            output_filename,
+            _with_progress(results, header, len(all_image_files)),
+            fps,
+            precision,
+            use_rgb,
+            music_offset,
+        )
+
+    if cache:
+        cache.evict()
+
+
+def run_stream(
+    frames: Iterator[NDArray[np.uint8]],
+    total_frames: int,
+    quality: int,
+    output_filename: str,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    subdivision: Optional[Subdivision] = None,
+    fps: float = 30,
+    precision: int = 1,
+    music_offset: int = 0,
+    static_threshold: int = -1,
+):
+    "Same as run, but takes already resized frames as they are being decoded."
+    nchunk = max(1, total_frames // number_of_splits)
+
+    def tasks(baselines) -> Iterator[Tuple[Any, ...]]:
+        previous: Optional[NDArray[np.uint8]] = None
+        i = 0
+        while True:
+            arr = list(islice(frames, nchunk))
+            if not arr:
+                return
+            yield (
+                arr,
+                quality,
+                nchunk * i,
+                use_rgb,
+                previous,
+                subdivision,
+                static_threshold,
+                *next(baselines),
+            )
+            previous = arr[-1]
+            i += 1
+
+    header = _header(quality, use_rgb)
+    temporal = subdivision is not None and subdivision.temporal
+    queues = baseline_queues(static_threshold > 0 or temporal)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        results = ordered_results(
+            pool, extract_arrays, tasks(baselines), number_of_thread + 1
+        )
+        generate_from_frames(
+            output_filename,
+            _with_progress(results, header, total_frames),
+            fps,
+            precision,
+            use_rgb,
+            music_offset,
+        )
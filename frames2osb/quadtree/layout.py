@@ -0,0 +1,359 @@
+import heapq
+import math
+from functools import cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb.quadtree.typings import FrameArray, QuadFrame, TreeState
+
+# Nodes are numbered implicitly. Within a level, a node's index is the Morton code
+# of its (row, column) in that level's grid, so the children of node m are
+# 4m + 0..3 in tl, tr, bl, br order, and its parent is m // 4. This is also the
+# breadth-first order the QuadNode trees of older datas/ files are flattened in.
+
+AxisSplit = Tuple[List[int], List[int], List[float]]
+
+
+def _split_axis(length: int, levels: int) -> List[AxisSplit]:
+    "Start, end and center of every segment along one axis, for every level."
+    # The root is centered on length // 2, like the extractor always did.
+    result: List[AxisSplit] = [([0], [length], [length // 2])]
+    for _ in range(levels - 1):
+        starts, ends, centers = result[-1]
+        next_starts: List[int] = []
+        next_ends: List[int] = []
+        next_centers: List[float] = []
+        for start, end, center in zip(starts, ends, centers):
+            # np.array_split gives the extra row/column to the first half.
+            first = math.ceil((end - start) / 2)
+            next_starts += [start, start + first]
+            next_ends += [start + first, end]
+            next_centers += [center - first / 2, center + first / 2]
+        result.append((next_starts, next_ends, next_centers))
+    return result
+
+
+def _deinterleave(
+    morton: NDArray[np.int64],
+) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+    rows = np.zeros_like(morton)
+    cols = np.zeros_like(morton)
+    # Eight levels only ever need 14 bits of Morton code.
+    for bit in range(16):
+        cols |= ((morton >> (2 * bit)) & 1) << bit
+        rows |= ((morton >> (2 * bit + 1)) & 1) << bit
+    return rows, cols
+
+
+class QuadLayout:
+    "Geometry of every possible node for a given frame size and quality."
+
+    def __init__(self, width: int, height: int, quality: int):
+        self.width = width
+        self.height = height
+        self.quality = quality
+
+        self._rows = _split_axis(height, quality)
+        self._cols = _split_axis(width, quality)
+
+        self.level_offsets: List[int] = [0]
+        self.row_index: List[NDArray[np.int64]] = []
+        self.col_index: List[NDArray[np.int64]] = []
+        for level in range(quality):
+            size = 4**level
+            self.level_offsets.append(self.level_offsets[-1] + size)
+            rows, cols = _deinterleave(np.arange(size, dtype=np.int64))
+            self.row_index.append(rows)
+            self.col_index.append(cols)
+
+        # Bounds as arrays, indexed by Morton code, for the builder.
+        self.y0 = [
+            np.array(self._rows[lv][0])[self.row_index[lv]] for lv in range(quality)
+        ]
+        self.y1 = [
+            np.array(self._rows[lv][1])[self.row_index[lv]] for lv in range(quality)
+        ]
+        self.x0 = [
+            np.array(self._cols[lv][0])[self.col_index[lv]] for lv in range(quality)
+        ]
+        self.x1 = [
+            np.array(self._cols[lv][1])[self.col_index[lv]] for lv in range(quality)
+        ]
+
+    @property
+    def node_count(self) -> int:
+        return self.level_offsets[-1]
+
+    def geometry(self, level: int, index: int) -> Tuple[float, float, int, int]:
+        "x, y, h, w of a node, level being depth - 1."
+        row = int(self.row_index[level][index])
+        col = int(self.col_index[level][index])
+        y_start, y_end, y = (axis[row] for axis in self._rows[level])
+        x_start, x_end, x = (axis[col] for axis in self._cols[level])
+        return x, y, int(y_end - y_start), int(x_end - x_start)
+
+
+@cache
+def get_layout(width: int, height: int, quality: int) -> QuadLayout:
+    return QuadLayout(width, height, quality)
+
+
+def _block_sums(table: NDArray, y0, y1, x0, x1) -> NDArray:
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+def _summed_area(values: NDArray, dtype=np.int32) -> NDArray:
+    # Even a 4K frame of 255s fits in int32, which is quite a bit faster than int64.
+    table = np.zeros(
+        (values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=dtype
+    )
+    np.cumsum(values, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def build_quadtree(image: FrameArray, offset: int, layout: QuadLayout) -> QuadFrame:
+    """Build a frame's quadtree a whole level at a time.
+
+    Every block's mean and uniformity comes from summed-area tables instead of
+    slicing the image."""
+    sums = _summed_area(image)
+
+    # A block is final when every row of it is a single colour, as it always was.
+    # So count the places where a pixel differs from its left neighbour.
+    row_changes = np.zeros(image.shape[:2], dtype=np.int32)
+    diff = image[:, 1:] != image[:, :-1]
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+    row_changes[:, 1:] = diff
+    changes = _summed_area(row_changes)
+
+    splits: List[NDArray[np.bool_]] = []
+    means: List[NDArray[np.int64]] = []
+
+    present = np.zeros(1, dtype=np.int64)
+    for level in range(layout.quality):
+        y0 = layout.y0[level][present]
+        y1 = layout.y1[level][present]
+        x0 = layout.x0[level][present]
+        x1 = layout.x1[level][present]
+
+        if level == layout.quality - 1:
+            split = np.zeros(len(present), dtype=np.bool_)
+        else:
+            # The first column of a block has nothing to its left within the block.
+            inner_x0 = np.minimum(x0 + 1, x1)
+            split = _block_sums(changes, y0, y1, inner_x0, x1) > 0
+            splits.append(split)
+
+        leaves = ~split
+        count = ((y1 - y0) * (x1 - x0))[leaves]
+        total = _block_sums(sums, y0[leaves], y1[leaves], x0[leaves], x1[leaves])
+        if total.ndim == 2:
+            count = count[:, None]
+        means.append(total // np.maximum(count, 1))
+
+        present = (present[split, None] * 4 + np.arange(4)).ravel()
+        if not len(present):
+            break
+
+    flat_means = np.concatenate(means).astype(np.uint8)
+    flat_splits = np.concatenate(splits) if splits else np.zeros(0, dtype=np.bool_)
+    return QuadFrame(offset, flat_splits, flat_means)
+
+
+def leaf_nodes(splits: NDArray[np.bool_], layout: QuadLayout) -> NDArray[np.int64]:
+    "Node ids (level offset + Morton code) of a frame's leaves, in breadth-first order."
+    leaves: List[NDArray[np.int64]] = []
+    present = np.zeros(1, dtype=np.int64)
+    start = 0
+    for level in range(layout.quality):
+        if level == layout.quality - 1:
+            split = np.zeros(len(present), dtype=np.bool_)
+        else:
+            split = splits[start : start + len(present)]  # noqa
+            start += len(present)
+
+        leaves.append(layout.level_offsets[level] + present[~split])
+        present = (present[split, None] * 4 + np.arange(4)).ravel()
+        if not len(present):
+            break
+    return np.concatenate(leaves)
+
+
+def empty_state(layout: QuadLayout, channels: int) -> TreeState:
+    shape: Tuple[int, ...] = (layout.node_count,)
+    if channels > 1:
+        shape += (channels,)
+    return TreeState(
+        np.zeros(layout.node_count, dtype=np.bool_),
+        np.zeros(layout.node_count, dtype=np.bool_),
+        np.zeros(shape, dtype=np.uint8),
+    )
+
+
+def _block_variance(
+    sums: NDArray, squares: NDArray, layout: QuadLayout, level: int, present: NDArray
+) -> NDArray[np.float64]:
+    "Variance of the given blocks of a level, the largest of their channels'."
+    y0 = layout.y0[level][present]
+    y1 = layout.y1[level][present]
+    x0 = layout.x0[level][present]
+    x1 = layout.x1[level][present]
+
+    count = np.maximum((y1 - y0) * (x1 - x0), 1)
+    total = _block_sums(sums, y0, y1, x0, x1)
+    if total.ndim == 2:
+        count = count[:, None]
+
+    variance = _block_sums(squares, y0, y1, x0, x1) / count - (total / count) ** 2
+    if variance.ndim == 2:
+        variance = variance.max(axis=1)
+    return variance
+
+
+def _split_bounds(
+    layout: QuadLayout,
+    level: int,
+    present: NDArray,
+    error: float,
+    state: Optional[TreeState],
+) -> NDArray[np.float64]:
+    bound = np.full(len(present), error, dtype=np.float64)
+    if state is not None:
+        # Staying split takes less than splitting, see build_error_quadtree.
+        bound[state.split[layout.level_offsets[level] + present]] = error / 2
+    return bound
+
+
+def _budget_splits(
+    sums: NDArray,
+    squares: NDArray,
+    layout: QuadLayout,
+    error: float,
+    max_leaves: int,
+    state: Optional[TreeState],
+) -> NDArray[np.bool_]:
+    """Which nodes to split, splitting the block with the most squared error first
+    until another split would go over max_leaves."""
+    splittable: List[List[bool]] = []
+    priority: List[List[float]] = []
+    for level in range(layout.quality - 1):
+        present = np.arange(4**level, dtype=np.int64)
+        variance = _block_variance(sums, squares, layout, level, present)
+        bound = _split_bounds(layout, level, present, error, state)
+        area = (layout.y1[level] - layout.y0[level]) * (
+            layout.x1[level] - layout.x0[level]
+        )
+        splittable.append((variance > bound**2).tolist())
+        priority.append((variance * area).tolist())
+
+    chosen = np.zeros(layout.node_count, dtype=np.bool_)
+    heap: List[Tuple[float, int, int]] = []
+    if splittable and splittable[0][0]:
+        heap.append((-priority[0][0], 0, 0))
+
+    leaves = 1
+    while heap and leaves + 3 <= max_leaves:
+        _, level, index = heapq.heappop(heap)
+        chosen[layout.level_offsets[level] + index] = True
+        leaves += 3
+
+        child_level = level + 1
+        if child_level == layout.quality - 1:
+            continue
+        for child in range(index * 4, index * 4 + 4):
+            if splittable[child_level][child]:
+                heapq.heappush(
+                    heap, (-priority[child_level][child], child_level, child)
+                )
+    return chosen
+
+
+def build_error_quadtree(
+    image: FrameArray,
+    offset: int,
+    layout: QuadLayout,
+    error: float,
+    max_leaves: int = 0,
+    state: Optional[TreeState] = None,
+) -> Tuple[QuadFrame, TreeState]:
+    """Build a frame's quadtree, splitting blocks whose standard deviation is above error.
+
+    With max_leaves, the blocks with the most squared error are split first and
+    splitting stops before the frame has more than max_leaves leaves.
+
+    With the state of the frame before, a block that was already split only
+    merges back once it is below error / 2. Likewise a leaf keeps its last mean
+    until the new one is more than error / 2 away. Noise then doesn't make leaves
+    flicker between frames, and the returned frame flags the leaves that actually
+    changed."""
+    sums = _summed_area(image)
+    # Squares of a whole frame easily overflow int32.
+    squares = _summed_area(image.astype(np.int64) ** 2, np.int64)
+    hysteresis = error / 2
+
+    chosen: Optional[NDArray[np.bool_]] = None
+    if max_leaves:
+        chosen = _budget_splits(sums, squares, layout, error, max_leaves, state)
+
+    channels = image.shape[2] if image.ndim == 3 else 1
+    new_state = empty_state(layout, channels)
+    if state is not None:
+        new_state.mean[:] = state.mean
+
+    splits: List[NDArray[np.bool_]] = []
+    means: List[NDArray[np.uint8]] = []
+    changed: List[NDArray[np.bool_]] = []
+
+    present = np.zeros(1, dtype=np.int64)
+    for level in range(layout.quality):
+        nodes = layout.level_offsets[level] + present
+        if level == layout.quality - 1:
+            split = np.zeros(len(present), dtype=np.bool_)
+        elif chosen is not None:
+            split = chosen[nodes]
+            splits.append(split)
+        else:
+            variance = _block_variance(sums, squares, layout, level, present)
+            bound = _split_bounds(layout, level, present, error, state)
+            split = variance > bound**2
+            splits.append(split)
+
+        leaves = present[~split]
+        leaf_ids = nodes[~split]
+        y0 = layout.y0[level][leaves]
+        y1 = layout.y1[level][leaves]
+        x0 = layout.x0[level][leaves]
+        x1 = layout.x1[level][leaves]
+        count = np.maximum((y1 - y0) * (x1 - x0), 1)
+        total = _block_sums(sums, y0, y1, x0, x1)
+        if total.ndim == 2:
+            count = count[:, None]
+        mean = (total // count).astype(np.uint8)
+
+        if state is not None:
+            last_mean = state.mean[leaf_ids]
+            delta = np.abs(mean.astype(np.int16) - last_mean)
+            if delta.ndim == 2:
+                delta = delta.max(axis=1)
+            kept = state.leaf[leaf_ids] & (delta <= hysteresis)
+            mean[kept] = last_mean[kept]
+            changed.append(~kept)
+
+        means.append(mean)
+        new_state.split[nodes[split]] = True
+        new_state.leaf[leaf_ids] = True
+        new_state.mean[leaf_ids] = mean
+
+        present = (present[split, None] * 4 + np.arange(4)).ravel()
+        if not len(present):
+            break
+
+    flat_splits = np.concatenate(splits) if splits else np.zeros(0, dtype=np.bool_)
+    # Without a frame before, every leaf is new.
+    flat_changed = np.concatenate(changed) if state is not None else None
+    frame = QuadFrame(offset, flat_splits, np.concatenate(means), flat_changed)
+    return frame, new_state
@@ -1,151 +1,360 @@
-import json
 import os
-import pickle
-from typing import Dict, List, Tuple, cast
+import struct
+import tempfile
+from contextlib import ExitStack
+from functools import cache
+from itertools import chain, repeat
+from multiprocessing.pool import Pool
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb import profiling
 from frames2osb.external.osbpy import Osbject
 from frames2osb.external.typings import OsbEasing
-from frames2osb.helper import ListProgressBar, get_max_resolution, sort_datas
-from frames2osb.quadtree.typings import FrameData, PixelData, QuadNode
+from frames2osb.helper import (
+    ListProgressBar,
+    PartFiles,
+    PartitionTask,
+    SimpleProgressBar,
+    generate_partitioned,
+    get_max_resolution,
+    sort_datas,
+)
+from frames2osb.quadtree.layout import QuadLayout, get_layout, leaf_nodes
+from frames2osb.quadtree.storage import FrameReader, QuadHeader
+from frames2osb.quadtree.typings import QuadFrame
 
 USE_AMOGUS = False
 
-pixels: Dict[str, PixelData] = {}
-children_keys: Dict[str, List[str]] = {}
+# Generating in parallel splits the tree at this depth: every subtree there is a
+# region, and the nodes above it are one more.
+REGION_DEPTH = 3
+# A frame in a region's file: its offset and number of leaves, then the leaves'
+# nodes as uint32 and their means.
+REGION_RECORD = struct.Struct("<qI")
 
 
-def disable_childs(key: str, offset: int):
-    for k in children_keys[key]:
-        if k in pixels and pixels[k].alpha != 0:
-            pixels[k].osb.fade(OsbEasing.NoEasing, offset, offset, 0, 0)
-            pixels[k].alpha = 0.0
-        disable_childs(k, offset)
+class NodeTable:
+    """Storyboard state of every node of the quadtree, in flat arrays.
 
+    Nodes are numbered like quadtree.layout does, their level's offset + their
+    Morton code, so a frame's leaves map straight onto the table. A node's object
+    is created the first time it is a leaf, and it is shown while its alpha isn't
+    0. Every frame, whatever is shown but isn't one of the frame's leaves belongs
+    to a parent or child of them, and gets hidden.
 
-def generate_particles(
-    quality: int,
-    frame: FrameData,
+    keys has the sort key of every object, in the order they were created: the
+    offset of the frame that created it, then its preorder. Objects from tables of
+    different regions are merged back by it in the order a single table makes."""
+
+    def __init__(self, layout: QuadLayout):
+        self.layout = layout
+        self.objects: List[Optional[Osbject]] = [None] * layout.node_count
+        self.keys: List[int] = []
+        # Nodes without an object count as hidden, new ones start at -1 so their
+        # first value is always written, like it always was.
+        self.alpha = np.zeros(layout.node_count, dtype=np.float64)
+        self.rgb = np.full(layout.node_count, -1, dtype=np.int64)
+
+        levels = [np.full(4**level, level) for level in range(layout.quality)]
+        self.level = np.concatenate(levels)
+        self.morton = np.concatenate(
+            [np.arange(4**level, dtype=np.int64) for level in range(layout.quality)]
+        )
+        # The order nodes are visited in when walking the tree depth first. Objects
+        # are created in that order, as it is what decides their order in the .osb.
+        self.preorder = self.morton << (2 * (layout.quality - 1 - self.level))
+
+
+def node_regions(layout: QuadLayout, depth: int) -> NDArray[np.int64]:
+    """Region of every node: 0 above depth, otherwise 1 + the Morton index of the
+    node at depth its subtree starts from."""
+    regions: List[NDArray[np.int64]] = []
+    for level in range(layout.quality):
+        if level + 1 < depth:
+            regions.append(np.zeros(4**level, dtype=np.int64))
+        else:
+            morton = np.arange(4**level, dtype=np.int64)
+            regions.append(1 + (morton >> (2 * (level + 1 - depth))))
+    return np.concatenate(regions)
+
+
+def create_object(table: NodeTable, node: int):
+    _, _, x_shift = get_max_resolution(1)
+    level = int(table.level[node])
+    x, y, h, w = table.layout.geometry(level, int(table.morton[node]))
+
+    if USE_AMOGUS:
+        obj = Osbject(
+            "res/amogus.png",
+            "Background",
+            "Centre",
+            x - x_shift,
+            y,
+            6,
+            68,
+            "LoopForever",
+        )
+        obj.scale(OsbEasing.NoEasing, 0, 0, 1, h / 1024)
+    else:
+        obj = Osbject("res/dot.png", "Background", "Centre", x - x_shift, y)
+        obj.vecscale(OsbEasing.NoEasing, 0, 0, 1, 1, w + 1, h + 1)
+    obj.fade(OsbEasing.NoEasing, 0, 0, 0, 0)
+
+    table.objects[node] = obj
+    table.alpha[node] = -1
+    table.rgb[node] = -1
+
+
+@cache
+def _alpha_levels(precision: int) -> NDArray[np.float64]:
+    "The faded alpha of every mean, rounded to precision."
+    return np.array([round(a / 255, precision) for a in range(256)])
+
+
+def _objects(table: NodeTable, nodes: NDArray[np.int64]) -> List[Osbject]:
+    objects = table.objects
+    return [objects[node] for node in nodes.tolist()]  # type: ignore
+
+
+def generate_frame(
+    table: NodeTable,
+    offset: int,
+    leaves: NDArray[np.int64],
+    means: NDArray[np.uint8],
     fps: float = 30,
     precision: int = 1,
     use_rgb: bool = False,
     music_offset: int = 0,
-    parent_key: str = "",
 ):
-    _, _, x_shift = get_max_resolution(1)
-    qtree: QuadNode = frame.quadtree
-    start_offset = music_offset + round(frame.offset * 1000 / fps)
-
-    # All this child thing is really bizarre, I know. I'll try to explain it:
-    # Basically, for "key" here is a childrent of "parent_key".
-    # By children, I mean it lives under "parent" pixels.
-    # And so we store ourself to the list of our parent's children.
-    #
-    # Here is a good tree of it:
-    #          vvvvvvvvvv               -----  vvvvvvvvv
-    #         > Parent 1 <              |     > Child 4 <
-    #          ^^^^^^^^^^               |      ^^^^^^^^^
-    #              |                    |          |
-    #        -----------------          |    -------------
-    #        |   |   |       |          |    |   |   |   |
-    #       ... ... ...   vvvvvvvvv     |   ... ... ... ...
-    #                    > Child 4 < ---       (Repeats)
-    #                     ^^^^^^^^^
-    # With this relationship in mind, if we are a parent and we are turning on
-    # our element, we can simply look at "children_keys" that we purpose as a
-    # table and recursively disable all childs within it.
-    key = "{0.x}:{0.y}:{0.w}:{0.h}".format(qtree)
-    if parent_key and key not in children_keys[parent_key]:
-        children_keys[parent_key].append(key)
-
-    if key not in children_keys:
-        children_keys[key] = []
-
-    if qtree.final or qtree._depth == quality:
-        # Recursively disable ALL childs (that means also disable child of child)
-        disable_childs(key, start_offset)
-        if key not in pixels:
-            # Initialize if this is the first time we are in the storyboard.
-            if USE_AMOGUS:
-                pixels[key] = PixelData(
-                    -1,
-                    -1,
-                    Osbject(
-                        "res/amogus.png",
-                        "Background",
-                        "Centre",
-                        qtree.x - x_shift,
-                        qtree.y,
-                        6,
-                        68,
-                        "LoopForever",
-                    ),
-                )
-                pixels[key].osb.scale(OsbEasing.NoEasing, 0, 0, 1, qtree.h / 1024)
-            else:
-                pixels[key] = PixelData(
-                    -1,
-                    -1,
-                    Osbject(
-                        "res/dot.png",
-                        "Background",
-                        "Centre",
-                        qtree.x - x_shift,
-                        qtree.y,
-                    ),
-                )
-                pixels[key].osb.vecscale(
-                    OsbEasing.NoEasing, 0, 0, 1, 1, qtree.w + 1, qtree.h + 1
-                )
-            pixels[key].osb.fade(OsbEasing.NoEasing, 0, 0, 0, 0)
-
-        if use_rgb:
-            # Cast hell because mypy
-            list_rgb = cast(List[int], qtree.mean.tolist())
-            mean_rgb = cast(Tuple[int, int, int], tuple(list_rgb))
-
-            if precision <= 0:
-                minimum_delta = 0.0
-            else:
-                minimum_delta = 10 / max(1, min(10, precision)) * 15
-
-            rgb_total = sum(mean_rgb)
-            if abs(rgb_total - pixels[key].rgb) > minimum_delta:
-                pixels[key].rgb = rgb_total
-                pixels[key].osb.colour(
-                    OsbEasing.NoEasing, start_offset, start_offset, *mean_rgb, *mean_rgb
-                )
-
-            if pixels[key].alpha <= 0:
-                pixels[key].osb.fade(
-                    OsbEasing.NoEasing, start_offset, start_offset, 1, 1
-                )
-                pixels[key].alpha = 1.0
+    """Show a frame's leaves, and hide what they cover.
+
+    leaves can be only some of the frame's, as long as the table never gets any
+    other frame's leaves from outside that part of the tree."""
+    start_offset = music_offset + round(offset * 1000 / fps)
+
+    # Initialize if this is the first time we are in the storyboard.
+    new = [node for node in leaves.tolist() if table.objects[node] is None]
+    if new:
+        new.sort(key=lambda node: table.preorder[node])
+        for node in new:
+            create_object(table, node)
+            key = offset * table.layout.node_count + int(table.preorder[node])
+            table.keys.append(key)
+
+    # Whatever was shown and isn't a leaf anymore is either a parent of a leaf, or
+    # under one. Either way, the leaf covers it now.
+    is_leaf = np.zeros(table.layout.node_count, dtype=np.bool_)
+    is_leaf[leaves] = True
+    hidden = np.flatnonzero((table.alpha != 0) & ~is_leaf)
+
+    fade_nodes: List[NDArray[np.int64]] = [hidden]
+    fade_values: List[float] = [0] * len(hidden)
+    table.alpha[hidden] = 0
+
+    if use_rgb:
+        if precision <= 0:
+            minimum_delta = 0.0
         else:
-            mean_alpha = qtree.mean.item()
-            alpha = round(mean_alpha / 255, precision)
-
-            if pixels[key].alpha != alpha:
-                pixels[key].alpha = alpha
-                pixels[key].osb.fade(
-                    OsbEasing.NoEasing, start_offset, start_offset, alpha, alpha
-                )
+            minimum_delta = 10 / max(1, min(10, precision)) * 15
+
+        rgb_total = means.astype(np.int64).sum(axis=1)
+        recolour = np.abs(rgb_total - table.rgb[leaves]) > minimum_delta
+        table.rgb[leaves[recolour]] = rgb_total[recolour]
+        Osbject.colour_bulk(
+            _objects(table, leaves[recolour]),
+            OsbEasing.NoEasing,
+            repeat(start_offset),
+            means[recolour].tolist(),
+        )
+
+        dark = leaves[table.alpha[leaves] <= 0]
+        table.alpha[dark] = 1.0
+        fade_nodes.append(dark)
+        fade_values += [1] * len(dark)
     else:
-        # Disable ourselves if any of our child is turning on.
-        if key in pixels and pixels[key].alpha != 0:
-            pixels[key].osb.fade(OsbEasing.NoEasing, start_offset, start_offset, 0, 0)
-            pixels[key].alpha = 0.0
-
-        for q in (qtree.tl, qtree.tr, qtree.bl, qtree.br):
-            if q:
-                generate_particles(
-                    quality,
-                    FrameData(frame.offset, q),
-                    fps,
-                    precision,
-                    use_rgb,
-                    music_offset,
-                    key,
-                )
+        alpha = _alpha_levels(precision)[means]
+        refade = table.alpha[leaves] != alpha
+        table.alpha[leaves[refade]] = alpha[refade]
+        fade_nodes.append(leaves[refade])
+        fade_values += alpha[refade].tolist()
+
+    Osbject.fade_bulk(
+        _objects(table, np.concatenate(fade_nodes)),
+        OsbEasing.NoEasing,
+        repeat(start_offset),
+        fade_values,
+    )
+
+
+FrameLeaves = Tuple[int, NDArray[np.int64], NDArray[np.uint8]]
+
+
+def _generate_leaves(
+    layout: QuadLayout,
+    frames: Iterable[FrameLeaves],
+    fps: float,
+    precision: int,
+    use_rgb: bool,
+    music_offset: int,
+) -> NodeTable:
+    table = NodeTable(layout)
+    for offset, leaves, means in frames:
+        with profiling.stage("generate") as record:
+            commands = Osbject.commands_added
+            generate_frame(
+                table, offset, leaves, means, fps, precision, use_rgb, music_offset
+            )
+            record.frames += 1
+            record.commands += Osbject.commands_added - commands
+    return table
+
+
+def _frame_leaves(
+    chunks: Iterable[Tuple[QuadHeader, Iterable[QuadFrame]]], layout: QuadLayout
+) -> Iterator[FrameLeaves]:
+    for _, frames in chunks:
+        for frame in frames:
+            yield frame.offset, leaf_nodes(frame.splits, layout), frame.means
+
+
+def _generate_chunks(
+    chunks: Iterable[Tuple[QuadHeader, Iterable[QuadFrame]]],
+    fps: float,
+    precision: int,
+    use_rgb: bool,
+    music_offset: int,
+):
+    chunk_iter = iter(chunks)
+    first = next(chunk_iter, None)
+    if first is None:
+        return
+
+    header = first[0]
+    layout = get_layout(header.width, header.height, header.quality)
+    frames = _frame_leaves(chain([first], chunk_iter), layout)
+    _generate_leaves(layout, frames, fps, precision, use_rgb, music_offset)
+
+
+def _read_frames(reader: FrameReader) -> Iterator[QuadFrame]:
+    frames = iter(reader)
+    while True:
+        with profiling.stage("load") as record:
+            frame = next(frames, None)
+            record.frames += int(frame is not None)
+        if frame is None:
+            return
+        yield frame
+
+
+def _read_datas(
+    quality: int, show_progress: bool = True
+) -> Iterator[Tuple[QuadHeader, Iterator[QuadFrame]]]:
+    "Frames of every data file, read one at a time as they are generated."
+    data_files = os.listdir("datas")
+    data_files.sort(key=sort_datas)
+
+    for data_file in ListProgressBar(data_files) if show_progress else data_files:
+        with FrameReader(os.path.join("datas", data_file), quality) as reader:
+            yield reader.header, _read_frames(reader)
+
+
+def _generate_frames(
+    quality: int,
+    fps: float,
+    precision: int,
+    use_rgb: bool,
+    music_offset: int,
+    show_progress: bool = True,
+):
+    chunks = _read_datas(quality, show_progress)
+    _generate_chunks(chunks, fps, precision, use_rgb, music_offset)
+
+
+@profiling.worker
+def _split_datas(task: Tuple[str, int, int, str]) -> QuadHeader:
+    """Write a data file's leaves out again, one file per region of the tree.
+
+    Frames are read and written one at a time. Every frame goes in every region's
+    file, even without any leaf there, as a region still has to hide what the
+    leaves of the other ones now cover."""
+    data_file, quality, depth, prefix = task
+    with ExitStack() as stack:
+        reader = stack.enter_context(
+            FrameReader(os.path.join("datas", data_file), quality)
+        )
+        header = reader.header
+        layout = get_layout(header.width, header.height, quality)
+        regions = node_regions(layout, depth)
+        files = [
+            stack.enter_context(open(f"{prefix}_{region}.bin", "wb"))
+            for region in range(4 ** (depth - 1) + 1)
+        ]
+
+        for frame in _read_frames(reader):
+            leaves = leaf_nodes(frame.splits, layout)
+            leaf_regions = regions[leaves]
+            with profiling.stage("serialize"):
+                for region, f in enumerate(files):
+                    inside = leaf_regions == region
+                    f.write(REGION_RECORD.pack(frame.offset, np.count_nonzero(inside)))
+                    f.write(leaves[inside].astype(np.uint32).tobytes())
+                    f.write(frame.means[inside].tobytes())
+    return header
+
+
+def _read_region(
+    prefixes: List[str], region: int, channels: int
+) -> Iterator[FrameLeaves]:
+    "Frames of a region, read one at a time out of the files _split_datas wrote."
+    for prefix in prefixes:
+        with open(f"{prefix}_{region}.bin", "rb") as f:
+            while True:
+                with profiling.stage("load") as record:
+                    head = f.read(REGION_RECORD.size)
+                    if not head:
+                        break
+                    offset, count = REGION_RECORD.unpack(head)
+                    leaves = np.frombuffer(f.read(count * 4), dtype=np.uint32)
+                    means = np.frombuffer(f.read(count * channels), dtype=np.uint8)
+                    if channels > 1:
+                        means = means.reshape(count, channels)
+                    record.frames += 1
+                yield offset, leaves.astype(np.int64), means
+
+
+@profiling.worker
+def _generate_region(task: PartitionTask) -> PartFiles:
+    (
+        (header, prefixes, region, fps, precision, use_rgb, music_offset),
+        settings,
+        prefix,
+    ) = task
+    Osbject.apply_settings(settings)
+
+    layout = get_layout(header.width, header.height, header.quality)
+    frames = _read_region(prefixes, region, header.channels)
+    table = _generate_leaves(layout, frames, fps, precision, use_rgb, music_offset)
+    with profiling.stage("write"):
+        return Osbject.write_parts(prefix), table.keys
+
+
+def generate_from_frames(
+    output_filename: str,
+    chunks: Iterable[Tuple[QuadHeader, Iterable[QuadFrame]]],
+    fps: float = 30,
+    precision: int = 1,
+    use_rgb: bool = False,
+    music_offset: int = 0,
+):
+    """Like generate_osb, but from the frames of every chunk instead of datas/.
+
+    Chunks have to come in frame order, and frames need every leaf's mean."""
+    _generate_chunks(chunks, fps, precision, use_rgb, music_offset)
+    with profiling.stage("write"):
+        Osbject.end(output_filename)
 
 
 def generate_osb(
@@ -155,26 +364,44 @@ def generate_osb(
     precision: int = 1,
     use_rgb: bool = False,
     music_offset: int = 0,
+    number_of_jobs: int = 1,
 ):
+    if quality == 1 or number_of_jobs <= 1:
+        _generate_frames(quality, fps, precision, use_rgb, music_offset)
+        with profiling.stage("write"):
+            Osbject.end(output_filename)
+        return
+
+    # A node's commands only depend on itself and its ancestors, so every region
+    # can be generated by its own process. Each data file is first split up by
+    # region, so that every process only loads the leaves it generates. Objects
+    # are merged back in the order generating them in one go creates them in.
+    depth = min(REGION_DEPTH, quality)
     data_files = os.listdir("datas")
     data_files.sort(key=sort_datas)
+    if not data_files:
+        Osbject.end(output_filename)
+        return
 
-    for data_file in ListProgressBar(data_files):
-        with open(os.path.join("datas", data_file), "rb") as f:
-            frame_data: List[FrameData] = [
-                FrameData.from_json(data) for data in json.load(f)
-            ]
-
-        for frame in frame_data:
-            generate_particles(
-                quality,
-                frame,
-                fps,
-                precision,
-                use_rgb,
-                music_offset,
-            )
-            del frame
-        del frame_data
+    with tempfile.TemporaryDirectory(prefix="regions_", dir=".") as directory:
+        prefixes = [
+            os.path.join(directory, os.path.splitext(data_file)[0])
+            for data_file in data_files
+        ]
+        tasks = [
+            (data_file, quality, depth, prefix)
+            for data_file, prefix in zip(data_files, prefixes)
+        ]
+
+        pbar = SimpleProgressBar(total=len(tasks))
+        with Pool(number_of_jobs) as pool:
+            for header in pool.imap(_split_datas, tasks):
+                pbar.update(1)
 
-    Osbject.end(output_filename)
+        partitions = [
+            (header, prefixes, region, fps, precision, use_rgb, music_offset)
+            for region in range(4 ** (depth - 1) + 1)
+        ]
+        generate_partitioned(
+            _generate_region, partitions, number_of_jobs, output_filename
+        )
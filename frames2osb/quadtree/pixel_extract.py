@@ -1,77 +1,488 @@
-import traceback
-import ujson
+import math
+from contextlib import ExitStack
 from multiprocessing import Pipe
-from multiprocessing.connection import PipeConnection
-import os
-import pickle
-import shutil
+from multiprocessing.connection import Connection
+from collections import deque
+from itertools import islice, repeat
 from multiprocessing.pool import AsyncResult, Pool
-from typing import List
+from queue import Queue
+from typing import Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
-from PIL import Image
+from numpy.typing import NDArray
 
+from frames2osb import profiling
+from frames2osb.cache import FrameCache
 from frames2osb.helper import (
     SimpleProgressBar,
     chunks,
+    get_frame_source,
+    average_frames,
+    baseline_queues,
+    chunk_size,
     get_max_resolution,
-    sort_image_files,
+    is_static,
+    open_frame,
+    reset_datas,
+    wait_results,
 )
-from frames2osb.quadtree.typings import FrameData, QuadNode
+from frames2osb.quadtree.storage import (
+    FrameWriter,
+    QuadHeader,
+    decode_frame,
+    encode_frame,
+    write_frames,
+)
+from frames2osb.quadtree.layout import (
+    build_quadtree,
+    build_error_quadtree,
+    get_layout,
+)
+from frames2osb.quadtree.typings import QuadFrame, Subdivision, TreeState
+from frames2osb.stack import FrameStack
 
-all_image_files = os.listdir("frames")
-all_image_files.sort(key=sort_image_files)
 
+def load_frame(
+    image_file: str, x_max: int, y_max: int, use_rgb: bool = False
+) -> NDArray[np.uint8]:
+    with profiling.stage("decode") as record:
+        record.frames += 1
+        im = open_frame(get_frame_source().path(image_file), x_max, y_max, use_rgb)
 
-def process_frames(
-    image_files: List[str],
+    with im, profiling.stage("resize"):
+        im_resized = im.resize((x_max, y_max))
+
+        if use_rgb:
+            return np.array(im_resized)
+        return np.array(im_resized.convert("L"))
+
+
+# What a chunk hands over to the next one: the last frame that wasn't skipped, and
+# with a temporal subdivision, the state and tree it was built into. See _build_frames.
+Baseline = Tuple[Optional[NDArray[np.uint8]], Optional[TreeState], Optional[QuadFrame]]
+
+
+def _build_frames(
+    frames: Iterable[NDArray[np.uint8]],
+    quality: int,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    previous: Optional[NDArray[np.uint8]] = None,
+    subdivision: Optional[Subdivision] = None,
+    static_threshold: int = -1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> Iterator[Tuple[QuadHeader, Optional[QuadFrame]]]:
+    """Build quadtrees from frames that are already resized to the storyboard size.
+
+    With a temporal subdivision, every tree is built against the one before it
+    and only the leaves that changed get stored, see build_error_quadtree.
+
+    Frames within static_threshold of the last frame that was kept, see
+    helper.is_static, are skipped: their frame is None, and the storyboard keeps
+    showing the last kept one.
+
+    Either way a frame depends on more than the one right before it, so the chunk
+    before this one puts its Baseline into baseline_in once it is done, and this
+    one puts its own into baseline_out, see helper.baseline_queues. Without them,
+    previous is the frame right before this chunk, if any, to start off from."""
+    state: Optional[TreeState] = None
+    last_image: Optional[NDArray[np.uint8]] = None
+    last_frame: Optional[QuadFrame] = None
+    temporal = subdivision is not None and subdivision.temporal
+    kept = previous
+    if baseline_in is not None:
+        # Load every frame while the chunk before this one is still being built.
+        frames = list(frames)
+        kept, state, last_frame = baseline_in.get()
+        last_image = kept
+    elif subdivision and temporal and previous is not None:
+        layout = get_layout(previous.shape[1], previous.shape[0], quality)
+        _, state = build_error_quadtree(
+            previous, 0, layout, subdivision.error, subdivision.max_leaves
+        )
+
+    channels = 3 if use_rgb else 1
+
+    for i, numpy_image in enumerate(frames):
+        y_max, x_max = numpy_image.shape[:2]
+        header = QuadHeader(quality, channels, x_max, y_max)
+        if is_static(numpy_image, kept, static_threshold):
+            yield header, None
+            continue
+        kept = numpy_image
+
+        with profiling.stage("extract") as record:
+            layout = get_layout(x_max, y_max, quality)
+            if not subdivision:
+                frame = build_quadtree(numpy_image, start_frame + i, layout)
+            elif (
+                temporal
+                and last_frame is not None
+                and last_image is not None
+                and np.array_equal(numpy_image, last_image)
+            ):
+                # Static scene, there is nothing to build.
+                frame = last_frame = last_frame._replace(
+                    offset=start_frame + i,
+                    changed=np.zeros(len(last_frame.means), dtype=np.bool_),
+                )
+            else:
+                frame, next_state = build_error_quadtree(
+                    numpy_image,
+                    start_frame + i,
+                    layout,
+                    subdivision.error,
+                    subdivision.max_leaves,
+                    state,
+                )
+                if temporal:
+                    last_frame, state = frame, next_state
+            record.frames += 1
+            record.events += _changed_leaves(frame)
+
+        yield header, frame
+        last_image = numpy_image
+
+    if baseline_out is not None:
+        baseline_out.put((kept, state, last_frame))
+
+
+@profiling.worker
+def process_arrays(
+    frames: Iterable[NDArray[np.uint8]],
     filename: str,
     quality: int,
-    pipe: PipeConnection,
+    pipe: Connection,
     start_frame: int = 0,
     use_rgb: bool = False,
+    previous: Optional[NDArray[np.uint8]] = None,
+    subdivision: Optional[Subdivision] = None,
+    static_threshold: int = -1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
 ):
-    x_max, y_max, _ = get_max_resolution(1)
-    max_depth = quality
+    "Build quadtrees from resized frames into filename, see _build_frames."
+    temporal = subdivision is not None and subdivision.temporal
+    trees = _build_frames(
+        frames,
+        quality,
+        start_frame,
+        use_rgb,
+        previous,
+        subdivision,
+        static_threshold,
+        baseline_in,
+        baseline_out,
+    )
+    with ExitStack() as stack:
+        writer: Optional[FrameWriter] = None
+        for header, frame in trees:
+            # Every frame is written as soon as it is built, so a chunk never has to
+            # fit in memory. The header needs the frames' size, hence the wait.
+            if writer is None:
+                writer = stack.enter_context(FrameWriter(filename, header, temporal))
+            if frame is not None:
+                _serialize(writer, frame)
+            pipe.send(1)
 
-    quad_frames: List[FrameData] = []
-    for i in range(len(image_files)):
-        image_file = image_files[i]
-        with Image.open(os.path.join("frames", image_file)) as im:
-            im_resized = im.resize((x_max, y_max))
+        if writer is None:
+            header = QuadHeader(quality, 3 if use_rgb else 1, 0, 0)
+            write_frames(filename, header, [])
 
-        if use_rgb:
-            numpy_image = np.array(im_resized)
+
+@profiling.worker
+def extract_arrays(
+    frames: Iterable[NDArray[np.uint8]],
+    quality: int,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    previous: Optional[NDArray[np.uint8]] = None,
+    subdivision: Optional[Subdivision] = None,
+    static_threshold: int = -1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> List[QuadFrame]:
+    "Like process_arrays, but the frames are returned instead of written to datas/."
+    trees = _build_frames(
+        frames,
+        quality,
+        start_frame,
+        use_rgb,
+        previous,
+        subdivision,
+        static_threshold,
+        baseline_in,
+        baseline_out,
+    )
+    return [frame for _, frame in trees if frame is not None]
+
+
+def _load_image(
+    image_file: str,
+    offset: int,
+    header: QuadHeader,
+    use_rgb: bool,
+    stack: Optional[FrameStack],
+) -> NDArray[np.uint8]:
+    if stack:
+        return stack[offset]
+    return load_frame(image_file, header.width, header.height, use_rgb)
+
+
+def load_quadtree(
+    image_file: str,
+    offset: int,
+    header: QuadHeader,
+    use_rgb: bool = False,
+    cache: Optional[FrameCache] = None,
+    subdivision: Optional[Subdivision] = None,
+    stack: Optional[FrameStack] = None,
+    numpy_image: Optional[NDArray[np.uint8]] = None,
+) -> QuadFrame:
+    "Build a frame's quadtree, or take it from the cache."
+    if cache:
+        key = cache.key(
+            get_frame_source().path(image_file),
+            "quadtree",
+            header.width,
+            header.height,
+            header.quality,
+            use_rgb,
+            tuple(subdivision or ()),
+        )
+        with profiling.stage("decode") as record:
+            data = cache.get(key)
+            if data is not None:
+                record.frames += 1
+                frame, _ = decode_frame(data, 0, header)
+                return frame._replace(offset=offset)
+
+    if numpy_image is None:
+        numpy_image = _load_image(image_file, offset, header, use_rgb, stack)
+    with profiling.stage("extract") as record:
+        layout = get_layout(header.width, header.height, header.quality)
+        if subdivision:
+            frame, _ = build_error_quadtree(
+                numpy_image, offset, layout, subdivision.error, subdivision.max_leaves
+            )
         else:
-            numpy_image = np.array(im_resized.convert("L"))
+            frame = build_quadtree(numpy_image, offset, layout)
+        if cache:
+            cache.put(key, encode_frame(frame._replace(offset=0)))
+        record.frames += 1
+        record.events += len(frame.means)
+    return frame
+
+
+def _changed_leaves(frame: QuadFrame) -> int:
+    if frame.changed is None:
+        return len(frame.means)
+    return int(np.count_nonzero(frame.changed))
 
-        qtree = QuadNode.from_image(
-            numpy_image, x_max // 2, y_max // 2, max_depth=max_depth
+
+def _serialize(writer: FrameWriter, frame: QuadFrame):
+    with profiling.stage("serialize") as record:
+        writer.write(frame)
+        record.frames += 1
+        record.events += _changed_leaves(frame)
+
+
+def _chunk_frames(
+    image_files: List[str],
+    header: QuadHeader,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    cache: Optional[FrameCache] = None,
+    previous_files: Sequence[str] = (),
+    subdivision: Optional[Subdivision] = None,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> Iterator[Optional[QuadFrame]]:
+    """Quadtrees of a chunk of frame files, built one at a time, None if skipped.
+
+    Every factor files are averaged into one frame, see helper.average_frames.
+    start_frame counts those, previous_files are the ones averaged into the frame
+    before the chunk. baseline_in and baseline_out are as in _build_frames."""
+    temporal = subdivision is not None and subdivision.temporal
+    # The stack has every file, not every averaged frame.
+    start = start_frame * factor
+    previous = None
+    if baseline_in is None and (static_threshold >= 0 or temporal):
+        first = start - len(previous_files)
+        previous_frames = (
+            _load_image(f, first + i, header, use_rgb, stack)
+            for i, f in enumerate(previous_files)
+        )
+        previous = next(average_frames(previous_frames, factor), None)
+
+    if temporal or factor > 1:
+        # Trees depend on the ones before them, or on several files, there is
+        # nothing to cache per file.
+        frames = (
+            _load_image(f, start + i, header, use_rgb, stack)
+            for i, f in enumerate(image_files)
+        )
+        trees = _build_frames(
+            average_frames(frames, factor),
+            header.quality,
+            start_frame,
+            use_rgb,
+            previous,
+            subdivision,
+            static_threshold,
+            baseline_in,
+            baseline_out,
         )
-        quad_frames.append(FrameData(start_frame + i, qtree))
-        pipe.send(1)
-        del im_resized
+        for _, frame in trees:
+            yield frame
+        return
+
+    kept = previous
+    images: Iterable[Optional[NDArray[np.uint8]]] = repeat(None)
+    if static_threshold >= 0:
+        # Frames have to be loaded to be compared, even when their tree is cached.
+        images = (
+            _load_image(f, start_frame + i, header, use_rgb, stack)
+            for i, f in enumerate(image_files)
+        )
+        if baseline_in is not None:
+            # Load every frame while the chunk before this one is still being built.
+            images = list(images)
+            kept, _, _ = baseline_in.get()
+
+    for (i, image_file), numpy_image in zip(enumerate(image_files), images):
+        if numpy_image is not None:
+            if is_static(numpy_image, kept, static_threshold):
+                yield None
+                continue
+            kept = numpy_image
+
+        yield load_quadtree(
+            image_file,
+            start_frame + i,
+            header,
+            use_rgb,
+            cache,
+            subdivision,
+            stack,
+            numpy_image,
+        )
+
+    if baseline_out is not None:
+        # Trees aren't temporal here, there is no state to hand over.
+        baseline_out.put((kept, None, None))
+
+
+def _chunk_header(quality: int, use_rgb: bool) -> QuadHeader:
+    x_max, y_max, _ = get_max_resolution(1)
+    return QuadHeader(quality, 3 if use_rgb else 1, x_max, y_max)
+
+
+@profiling.worker
+def process_frames(
+    image_files: List[str],
+    filename: str,
+    quality: int,
+    pipe: Connection,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    cache: Optional[FrameCache] = None,
+    previous_files: Sequence[str] = (),
+    subdivision: Optional[Subdivision] = None,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+):
+    header = _chunk_header(quality, use_rgb)
+    temporal = subdivision is not None and subdivision.temporal
+    trees = _chunk_frames(
+        image_files,
+        header,
+        start_frame,
+        use_rgb,
+        cache,
+        previous_files,
+        subdivision,
+        stack,
+        static_threshold,
+        factor,
+        baseline_in,
+        baseline_out,
+    )
+    with FrameWriter(filename, header, temporal) as writer:
+        for frame in trees:
+            if frame is not None:
+                _serialize(writer, frame)
+            pipe.send(1)
 
-    output = [q.to_json() for q in quad_frames]
-    with open(filename, "w") as f:
-        ujson.dump(output, f)
 
-    del quad_frames
+@profiling.worker
+def extract_frames(
+    image_files: List[str],
+    quality: int,
+    start_frame: int = 0,
+    use_rgb: bool = False,
+    cache: Optional[FrameCache] = None,
+    previous_files: Sequence[str] = (),
+    subdivision: Optional[Subdivision] = None,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+    baseline_in: Optional[Queue] = None,
+    baseline_out: Optional[Queue] = None,
+) -> List[QuadFrame]:
+    "Like process_frames, but the frames are returned instead of written to datas/."
+    header = _chunk_header(quality, use_rgb)
+    trees = _chunk_frames(
+        image_files,
+        header,
+        start_frame,
+        use_rgb,
+        cache,
+        previous_files,
+        subdivision,
+        stack,
+        static_threshold,
+        factor,
+        baseline_in,
+        baseline_out,
+    )
+    return [frame for frame in trees if frame is not None]
 
 
-def run(quality: int, use_rgb: bool = False, number_of_thread=2, number_of_splits=16):
-    try:
-        shutil.rmtree("datas")
-    except FileNotFoundError:
-        pass
-    os.makedirs("datas", exist_ok=True)
+def run(
+    quality: int,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    cache: Optional[FrameCache] = None,
+    subdivision: Optional[Subdivision] = None,
+    stack: Optional[FrameStack] = None,
+    static_threshold: int = -1,
+    factor: int = 1,
+):
+    reset_datas()
+
+    all_image_files = get_frame_source().files
 
-    pbar = SimpleProgressBar(total=len(all_image_files))
-    with Pool(number_of_thread) as pool:
+    pbar = SimpleProgressBar(total=math.ceil(len(all_image_files) / factor))
+    temporal = subdivision is not None and subdivision.temporal
+    queues = baseline_queues(static_threshold > 0 or temporal)
+    with queues as baselines, Pool(number_of_thread) as pool:
         parent_conn, child_conn = Pipe()
-        nchunk = len(all_image_files) // number_of_splits
-        results: List[AsyncResult] = []
-        for i, arr in enumerate(chunks(all_image_files, nchunk)):
+        nchunk = chunk_size(len(all_image_files), number_of_splits, factor)
+        pending: Deque[AsyncResult] = deque()
+        for (i, arr), (baseline_in, baseline_out) in zip(
+            enumerate(chunks(all_image_files, nchunk)), baselines
+        ):
+            start = nchunk * i
+            previous_files = all_image_files[max(0, start - factor) : start]  # noqa
             result = pool.apply_async(
                 process_frames,
                 args=(
@@ -79,16 +490,80 @@ def run(quality: int, use_rgb: bool = False, number_of_thread=2, number_of_split
                     f"datas/data_{i}.dat",
                     quality,
                     child_conn,
-                    nchunk * i,
+                    start // factor,
                     use_rgb,
+                    cache,
+                    previous_files,
+                    subdivision,
+                    stack,
+                    static_threshold,
+                    factor,
+                    baseline_in,
+                    baseline_out,
                 ),
-                error_callback=lambda x: traceback.print_exception(x),
             )
-            results.append(result)
+            pending.append(result)
 
         pool.close()
-        while pbar.current < pbar.total - 1:
-            parent_conn.recv()
-            pbar.update(1)
+        wait_results(pending, parent_conn, pbar)
+        pool.join()
+
+    if cache:
+        cache.evict()
 
+
+def run_stream(
+    frames: Iterator[NDArray[np.uint8]],
+    total_frames: int,
+    quality: int,
+    use_rgb: bool = False,
+    number_of_thread=2,
+    number_of_splits=16,
+    subdivision: Optional[Subdivision] = None,
+    static_threshold: int = -1,
+):
+    "Same as run, but takes already resized frames as they are being decoded."
+    reset_datas()
+
+    pbar = SimpleProgressBar(total=total_frames)
+    temporal = subdivision is not None and subdivision.temporal
+    queues = baseline_queues(static_threshold > 0 or temporal)
+    with queues as baselines, Pool(number_of_thread) as pool:
+        parent_conn, child_conn = Pipe()
+        nchunk = max(1, total_frames // number_of_splits)
+        pending: Deque[AsyncResult] = deque()
+        previous: Optional[NDArray[np.uint8]] = None
+        i = 0
+        while True:
+            arr = list(islice(frames, nchunk))
+            if not arr:
+                break
+
+            baseline_in, baseline_out = next(baselines)
+            pending.append(
+                pool.apply_async(
+                    process_arrays,
+                    args=(
+                        arr,
+                        f"datas/data_{i}.dat",
+                        quality,
+                        child_conn,
+                        nchunk * i,
+                        use_rgb,
+                        previous,
+                        subdivision,
+                        static_threshold,
+                        baseline_in,
+                        baseline_out,
+                    ),
+                )
+            )
+            previous = arr[-1]
+            i += 1
+
+            # Don't decode too far ahead of the workers, or every frame ends up in memory.
+            wait_results(pending, parent_conn, pbar, number_of_thread)
+
+        pool.close()
+        wait_results(pending, parent_conn, pbar)
         pool.join()
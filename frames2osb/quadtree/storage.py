@@ -0,0 +1,260 @@
+import json
+import struct
+from collections import deque
+from typing import Deque, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from frames2osb.quadtree.layout import QuadLayout, empty_state, get_layout, leaf_nodes
+from frames2osb.quadtree.typings import FrameData, MeanValue, QuadFrame, QuadNode
+
+# File layout:
+#   header: magic, version, quality, channels, width, height
+#   then one record per frame:
+#     offset, number of split flags, number of leaves
+#     split flags, one bit per node above max depth in breadth-first order
+#     leaf means, uint8 * channels per leaf in breadth-first order
+#
+# Version 2 files come from temporal extraction, their records also have the
+# number of changed leaves after the number of leaves, a changed flag per leaf
+# after the split flags, and only the changed leaves' means. The other leaves
+# keep the mean their node had in the frame before.
+#
+# Node geometry is not stored at all, it is implied by the depth and the
+# root's width/height, see quadtree.layout. A record's size follows from the
+# counts at its start, so records can be written and read one at a time.
+MAGIC = b"F2OQ"
+VERSION = 1
+DELTA_VERSION = 2
+HEADER = struct.Struct("<4sBBBxII")
+RECORD = struct.Struct("<III")
+DELTA_RECORD = struct.Struct("<IIII")
+
+
+class QuadHeader(NamedTuple):
+    quality: int
+    channels: int
+    width: int
+    height: int
+
+
+def flatten_quadtree(frame: FrameData, quality: int) -> QuadFrame:
+    "Turn a QuadNode tree into its breadth-first split flags and leaf means."
+    flags: List[bool] = []
+    means: List[MeanValue] = []
+
+    queue: Deque[QuadNode] = deque([frame.quadtree])
+    while queue:
+        node = queue.popleft()
+        children = [c for c in (node.tl, node.tr, node.bl, node.br) if c]
+        if node._depth < quality:
+            flags.append(bool(children))
+
+        if children:
+            queue.extend(children)
+        else:
+            assert node.mean is not None
+            means.append(node.mean)
+
+    return QuadFrame(
+        frame.offset,
+        np.array(flags, dtype=np.bool_),
+        np.array(means, dtype=np.uint8),
+    )
+
+
+def encode_frame(frame: QuadFrame) -> bytes:
+    packed_flags = np.packbits(frame.splits).tobytes()
+    return (
+        RECORD.pack(frame.offset, len(frame.splits), len(frame.means))
+        + packed_flags
+        + frame.means.tobytes()
+    )
+
+
+def encode_delta_frame(frame: QuadFrame) -> bytes:
+    changed = frame.changed
+    if changed is None:
+        changed = np.ones(len(frame.means), dtype=np.bool_)
+    changed_means = frame.means[changed]
+    return (
+        DELTA_RECORD.pack(
+            frame.offset, len(frame.splits), len(frame.means), len(changed_means)
+        )
+        + np.packbits(frame.splits).tobytes()
+        + np.packbits(changed).tobytes()
+        + changed_means.tobytes()
+    )
+
+
+def _unpack_flags(buf: bytes, pos: int, count: int) -> Tuple[np.ndarray, int]:
+    flag_bytes = (count + 7) // 8
+    flags = np.unpackbits(
+        np.frombuffer(buf, dtype=np.uint8, count=flag_bytes, offset=pos),
+        count=count,
+    ).astype(np.bool_)
+    return flags, pos + flag_bytes
+
+
+def _read_means(
+    buf: bytes, pos: int, count: int, header: QuadHeader
+) -> Tuple[np.ndarray, int]:
+    mean_size = count * header.channels
+    means = np.frombuffer(buf, dtype=np.uint8, count=mean_size, offset=pos)
+    if header.channels > 1:
+        means = means.reshape(count, header.channels)
+    return means, pos + mean_size
+
+
+def decode_delta_frame(
+    buf: bytes, pos: int, header: QuadHeader
+) -> Tuple[QuadFrame, int]:
+    "A delta record, its means are only those of the changed leaves."
+    offset, n_flags, n_leaves, n_changed = DELTA_RECORD.unpack_from(buf, pos)
+    pos += DELTA_RECORD.size
+    splits, pos = _unpack_flags(buf, pos, n_flags)
+    changed, pos = _unpack_flags(buf, pos, n_leaves)
+    means, pos = _read_means(buf, pos, n_changed, header)
+    return QuadFrame(offset, splits, means, changed), pos
+
+
+def decode_frame(buf: bytes, pos: int, header: QuadHeader) -> Tuple[QuadFrame, int]:
+    offset, n_flags, n_leaves = RECORD.unpack_from(buf, pos)
+    pos += RECORD.size
+    splits, pos = _unpack_flags(buf, pos, n_flags)
+    means, pos = _read_means(buf, pos, n_leaves, header)
+    return QuadFrame(offset, splits, means), pos
+
+
+def fill_means(
+    frame: QuadFrame, layout: QuadLayout, node_means: np.ndarray
+) -> QuadFrame:
+    """Give every leaf of a delta frame its mean.
+
+    node_means holds the last mean of every node, and is updated with this frame."""
+    assert frame.changed is not None
+    leaves = leaf_nodes(frame.splits, layout)
+    means = node_means[leaves]
+    means[frame.changed] = frame.means
+    node_means[leaves[frame.changed]] = frame.means
+    return QuadFrame(frame.offset, frame.splits, means, frame.changed)
+
+
+class FrameWriter:
+    """Writes a chunk one frame at a time, so only the frame being written has to
+    be in memory.
+
+    Whether it is a delta file has to be known before the first frame, frames from
+    temporal extraction are only worth anything as one. The first frame of a delta
+    file is always stored whole, as its reader has no frame before it to take the
+    unchanged leaves from."""
+
+    def __init__(self, filename: str, header: QuadHeader, delta: bool = False):
+        self._encode = encode_delta_frame if delta else encode_frame
+        self._first = True
+        self._file = open(filename, "wb")
+        self._file.write(
+            HEADER.pack(MAGIC, DELTA_VERSION if delta else VERSION, *header)
+        )
+
+    def write(self, frame: QuadFrame):
+        if self._first:
+            frame = frame._replace(changed=None)
+            self._first = False
+        self._file.write(self._encode(frame))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "FrameWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_frames(filename: str, header: QuadHeader, frames: List[QuadFrame]):
+    delta = any(frame.changed is not None for frame in frames)
+    with FrameWriter(filename, header, delta) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+
+class FrameReader:
+    """Reads a chunk one frame at a time, every frame with all of its leaves' means.
+
+    Records are read as they are iterated over, so only one frame is in memory
+    at a time. Chunks from before the binary format are plain JSON, and are read
+    whole. quality is only used for those."""
+
+    def __init__(self, filename: str, quality: int):
+        self._file = open(filename, "rb")
+        self._legacy: Optional[List[QuadFrame]] = None
+
+        start = self._file.read(HEADER.size)
+        if not start.startswith(MAGIC):
+            self._read_legacy(start + self._file.read(), quality)
+            return
+
+        _, self.version, *fields = HEADER.unpack(start)
+        if self.version not in (VERSION, DELTA_VERSION):
+            self._file.close()
+            raise ValueError(f"Unsupported quadtree data version {self.version}.")
+        self.header = QuadHeader(*fields)
+
+    def _read_legacy(self, buf: bytes, quality: int):
+        self.version = 0
+        legacy = [FrameData.from_json(data) for data in json.loads(buf)]
+        self._legacy = [flatten_quadtree(frame, quality) for frame in legacy]
+        if not legacy:
+            self.header = QuadHeader(quality, 1, 0, 0)
+            return
+
+        # Every node of an old tree has a mean, RGB ones have three.
+        root = legacy[0].quadtree
+        channels = 3 if np.ndim(root.mean) else 1
+        self.header = QuadHeader(quality, channels, root.w, root.h)
+
+    def _read_record(self) -> Optional[bytes]:
+        record = RECORD if self.version == VERSION else DELTA_RECORD
+        head = self._file.read(record.size)
+        if len(head) < record.size:
+            return None
+
+        _, n_flags, n_leaves, *n_changed = record.unpack(head)
+        size = (n_flags + 7) // 8
+        if self.version == VERSION:
+            size += n_leaves * self.header.channels
+        else:
+            size += (n_leaves + 7) // 8 + n_changed[0] * self.header.channels
+        return head + self._file.read(size)
+
+    def __iter__(self) -> Iterator[QuadFrame]:
+        if self._legacy is not None:
+            yield from self._legacy
+            return
+
+        if self.version == VERSION:
+            while True:
+                buf = self._read_record()
+                if buf is None:
+                    return
+                yield decode_frame(buf, 0, self.header)[0]
+
+        layout = get_layout(self.header.width, self.header.height, self.header.quality)
+        node_means = empty_state(layout, self.header.channels).mean
+        while True:
+            buf = self._read_record()
+            if buf is None:
+                return
+            frame, _ = decode_delta_frame(buf, 0, self.header)
+            yield fill_means(frame, layout, node_means)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "FrameReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,14 +1,10 @@
-from dataclasses import dataclass
-from functools import reduce
-from operator import add
-from typing import Any, List, NamedTuple, Optional, Union
+from typing import Any, NamedTuple, Optional
 
 import numpy as np
 from numpy.typing import NDArray
 
-from frames2osb.external.osbpy import Osbject
-
-ImageArray = NDArray[np.int32]
+# Frames as decoded, or anything wider, the summed-area tables widen them anyway.
+FrameArray = NDArray[np.integer[Any]]
 MeanValue = np.signedinteger[Any] | NDArray[np.int32]
 
 
@@ -24,31 +20,63 @@ class FrameData(NamedTuple):
         return cls(data["offset"], QuadNode.from_json(data["quadtree"]))
 
 
-@dataclass
-class PixelData:
-    rgb: int
-    alpha: float
-    osb: Osbject
+class QuadFrame(NamedTuple):
+    """A frame's quadtree without any node objects.
 
+    splits has one flag per node above max depth and means has one entry per leaf,
+    both in breadth-first order. Geometry is implied, see quadtree.layout.
 
-# Code starting here are taken from
-# https://medium.com/analytics-vidhya/transform-an-image-into-a-quadtree-39b3aa6e019a
-# with quite a number of modification to fit my purpose.
-def calculate_mean(img: ImageArray) -> Union[np.int32, ImageArray]:
-    return np.mean(img, axis=(0, 1), dtype=np.int32)
+    changed, when set, flags the leaves that differ from the frame before. Only
+    those get their mean stored, the others are carried over when read back."""
+
+    offset: int
+    splits: NDArray[np.bool_]
+    means: NDArray[np.uint8]
+    changed: Optional[NDArray[np.bool_]] = None
+
+
+class Subdivision(NamedTuple):
+    """How to split blocks instead of only keeping uniform ones, see
+    quadtree.layout.build_error_quadtree.
 
+    With temporal, every frame's tree is built against the last one's."""
 
-def quad_split(image: ImageArray) -> List[ImageArray]:
-    half_split = np.array_split(image, 2)
-    res = map(lambda x: np.array_split(x, 2, axis=1), half_split)
-    return reduce(add, res)
+    error: float = 0
+    max_leaves: int = 0
+    temporal: bool = False
 
 
+class TreeState(NamedTuple):
+    """Every node of the last frame, indexed by its level's offset + its Morton code.
+
+    Used to build the next frame's tree against the last one, see
+    quadtree.layout.build_error_quadtree."""
+
+    split: NDArray[np.bool_]
+    leaf: NDArray[np.bool_]
+    mean: NDArray[np.uint8]
+
+
+# Code starting here are taken from
+# https://medium.com/analytics-vidhya/transform-an-image-into-a-quadtree-39b3aa6e019a
+# with quite a number of modification to fit my purpose.
 class QuadNode:
-    tl: Optional["QuadNode"] = None
-    tr: Optional["QuadNode"] = None
-    bl: Optional["QuadNode"] = None
-    br: Optional["QuadNode"] = None
+    # Frames hold thousands of nodes, so don't give each of them a __dict__.
+    __slots__ = (
+        "_depth",
+        "_max_depth",
+        "mean",
+        "resolution",
+        "x",
+        "y",
+        "h",
+        "w",
+        "final",
+        "tl",
+        "tr",
+        "bl",
+        "br",
+    )
 
     def __init__(
         self,
@@ -56,11 +84,16 @@ class QuadNode:
         y: float,
         h: int,
         w: int,
-        mean: MeanValue,
+        mean: Optional[MeanValue],
         final: bool = False,
         depth: int = 1,
         max_depth: int = 7,
     ):
+        self.tl: Optional["QuadNode"] = None
+        self.tr: Optional["QuadNode"] = None
+        self.bl: Optional["QuadNode"] = None
+        self.br: Optional["QuadNode"] = None
+
         self._depth = depth
         self._max_depth = max_depth
 
@@ -73,34 +106,17 @@ class QuadNode:
         self.w = self.resolution[1]
         self.final = final
 
-    @classmethod
-    def from_image(
-        cls,
-        image: ImageArray,
-        x: float,
-        y: float,
-        depth: int = 1,
-        max_depth: int = 7,
-    ):
-        mean = calculate_mean(image)
-        # We don't want the storyboard to be very very detailed so limit the max depth.
-        # Max depth is 1-7.
-        final = depth == max_depth or all(np.all(x == x[0]) for x in image)
-        resolution = image.shape[:2]
-
-        result = QuadNode(
-            x, y, resolution[0], resolution[1], mean, final, depth, max_depth
-        )
-        result.create_depth(image)
-        return result
-
     def to_json(self):
+        mean: Any = None
+        if isinstance(self.mean, np.signedinteger):
+            mean = self.mean.item()
+        elif self.mean is not None:
+            mean = self.mean.tolist()
+
         return {
             "_depth": self._depth,
             "_max_depth": self._max_depth,
-            "mean": self.mean.item()
-            if isinstance(self.mean, np.signedinteger)
-            else self.mean.tolist(),
+            "mean": mean,
             "resolution": self.resolution,
             "x": self.x,
             "y": self.y,
@@ -115,10 +131,10 @@ class QuadNode:
 
     @classmethod
     def from_json(cls, data: dict):
-        mean: MeanValue
+        mean: Optional[MeanValue] = None
         if isinstance(data["mean"], int):
             mean = np.int32(data["mean"])
-        else:
+        elif data["mean"] is not None:
             mean = np.array(data["mean"])
 
         self = QuadNode(
@@ -127,6 +143,7 @@ class QuadNode:
             data["h"],
             data["w"],
             mean,
+            final=data["final"],
             depth=data["_depth"],
             max_depth=data["_max_depth"],
         )
@@ -136,39 +153,3 @@ class QuadNode:
         self.bl = QuadNode.from_json(data["bl"]) if data["bl"] else None
         self.br = QuadNode.from_json(data["br"]) if data["br"] else None
         return self
-
-    def create_depth(self, image_pixels):
-        if self.final:
-            return
-        split_img = quad_split(image_pixels)
-
-        # Maybe trigonometry could help my ass here but I cba lol
-        next_depth = self._depth + 1
-        self.tl = type(self).from_image(
-            split_img[0],
-            self.x - split_img[0].shape[1] / 2,
-            self.y - split_img[0].shape[0] / 2,
-            depth=next_depth,
-            max_depth=self._max_depth,
-        )
-        self.tr = type(self).from_image(
-            split_img[1],
-            self.x + split_img[0].shape[1] / 2,
-            self.y - split_img[0].shape[0] / 2,
-            depth=next_depth,
-            max_depth=self._max_depth,
-        )
-        self.bl = type(self).from_image(
-            split_img[2],
-            self.x - split_img[0].shape[1] / 2,
-            self.y + split_img[0].shape[0] / 2,
-            depth=next_depth,
-            max_depth=self._max_depth,
-        )
-        self.br = type(self).from_image(
-            split_img[3],
-            self.x + split_img[0].shape[1] / 2,
-            self.y + split_img[0].shape[0] / 2,
-            depth=next_depth,
-            max_depth=self._max_depth,
-        )
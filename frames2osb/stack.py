@@ -0,0 +1,129 @@
+import json
+import os
+from multiprocessing.pool import Pool
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from frames2osb import profiling
+from frames2osb.helper import SimpleProgressBar, chunks, get_frame_source, open_frame
+
+# Bump when how frames are decoded or resized changes, older stacks are rebuilt.
+STACK_VERSION = 1
+
+
+def resize_frame(
+    image_file: str, width: int, height: int, use_rgb: bool = False
+) -> NDArray[np.uint8]:
+    with profiling.stage("decode") as record:
+        record.frames += 1
+        im = open_frame(get_frame_source().path(image_file), width, height, use_rgb)
+
+    with im, profiling.stage("resize"):
+        im_resized = im.resize((width, height))
+        if use_rgb:
+            return np.asarray(im_resized)
+        return np.asarray(im_resized.convert("L"))
+
+
+class FrameStack:
+    """Every frame resized to width x height, in a single .npy file in directory.
+
+    A stack is built once per resolution and colour mode, and reused by every run
+    that extracts at that resolution until the frames change. It is memory-mapped,
+    so slicing it copies nothing, and it is pickled as its filename only: pool
+    workers map the file themselves instead of receiving the frames."""
+
+    def __init__(
+        self, width: int, height: int, use_rgb: bool = False, directory: str = "stacks"
+    ):
+        self.width = width
+        self.height = height
+        self.use_rgb = use_rgb
+        name = f"{width}x{height}_{'rgb' if use_rgb else 'gray'}"
+        self.filename = os.path.join(directory, name + ".npy")
+        self.meta_file = os.path.join(directory, name + ".json")
+        self._frames: Optional[NDArray[np.uint8]] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {**self.__dict__, "_frames": None}
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        size = (len(get_frame_source()), self.height, self.width)
+        return size + (3,) if self.use_rgb else size
+
+    def _meta(self) -> Dict[str, Any]:
+        source = get_frame_source()
+        width, height = source.size
+        # Frames get overwritten under the same names, e.g. by another --video.
+        stats = [os.stat(source.path(f)) for f in source.files]
+        return {
+            "version": STACK_VERSION,
+            "size": [width, height],
+            "files": source.files,
+            "stats": [[stat.st_mtime_ns, stat.st_size] for stat in stats],
+        }
+
+    def is_built(self) -> bool:
+        try:
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta == self._meta() and os.path.exists(self.filename)
+
+    def build(self, number_of_thread=2, number_of_splits=16):
+        "Resize every frame into the stack, replacing whatever was there."
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        try:
+            os.remove(self.meta_file)
+        except FileNotFoundError:
+            pass
+
+        # Workers fill their own slices of a temporary file, readers never see it.
+        tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        np.lib.format.open_memmap(
+            tmp_filename, mode="w+", dtype=np.uint8, shape=self.shape
+        ).flush()
+
+        all_image_files = get_frame_source().files
+        nchunk = max(1, len(all_image_files) // number_of_splits)
+        tasks = [
+            (tmp_filename, nchunk * i, arr, self.width, self.height, self.use_rgb)
+            for i, arr in enumerate(chunks(all_image_files, nchunk))
+        ]
+
+        pbar = SimpleProgressBar(total=len(all_image_files))
+        with Pool(number_of_thread) as pool:
+            for done in pool.imap_unordered(_fill_stack, tasks):
+                pbar.update(done)
+
+        os.replace(tmp_filename, self.filename)
+        with open(self.meta_file, "w") as f:
+            json.dump(self._meta(), f)
+        self._frames = None
+
+    @property
+    def frames(self) -> NDArray[np.uint8]:
+        if self._frames is None:
+            self._frames = np.load(self.filename, mmap_mode="r")
+        return self._frames
+
+    def slice(self, start: int, count: int) -> NDArray[np.uint8]:
+        end = start + count
+        return self.frames[start:end]
+
+    def __getitem__(self, index: int) -> NDArray[np.uint8]:
+        return self.frames[index]
+
+
+@profiling.worker
+def _fill_stack(task: Tuple[str, int, List[str], int, int, bool]) -> int:
+    filename, start, image_files, width, height, use_rgb = task
+    stack = np.load(filename, mmap_mode="r+")
+    for i, image_file in enumerate(image_files):
+        stack[start + i] = resize_frame(image_file, width, height, use_rgb)
+    stack.flush()
+    return len(image_files)
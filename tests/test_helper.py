@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from frames2osb.helper import FrameSource
+
+
+def _write_frames(directory: str, width: int, height: int):
+    for i in range(3):
+        image = np.zeros((height, width), dtype=np.uint8)
+        Image.fromarray(image).save(os.path.join(directory, f"{i:03d}.png"))
+
+
+def test_frame_size_follows_frames_written_in_place(tmp_path):
+    frames = tmp_path / "frames"
+    frames.mkdir()
+    _write_frames(str(frames), 64, 48)
+    assert FrameSource(str(frames)).size == (64, 48)
+
+    # Overwriting the files doesn't modify the folder itself.
+    modified = os.stat(frames).st_mtime_ns
+    _write_frames(str(frames), 128, 72)
+    os.utime(frames, ns=(modified, modified))
+    assert FrameSource(str(frames)).size == (128, 72)
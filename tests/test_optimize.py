@@ -0,0 +1,14 @@
+from frames2osb.optimize import fit_linear
+
+SPRITE = 'Sprite,Background,Centre,"res/dot.png",320,240'
+
+
+def test_fit_linear_merges_a_linear_fade():
+    lines = [SPRITE, " F,0,0,,0", " F,0,100,,0.5", " F,0,200,,1"]
+    assert fit_linear(lines, tolerance=0.01) == [SPRITE, " F,0,0,200,0,1"]
+
+
+def test_fit_linear_keeps_eased_commands():
+    # Only the second command is eased, the ramp would still fit its value.
+    lines = [SPRITE, " F,0,0,,0", " F,1,100,,0.5", " F,0,200,,1"]
+    assert fit_linear(lines, tolerance=0.01) == lines
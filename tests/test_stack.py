@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from frames2osb.helper import FrameSource, set_frame_source
+from frames2osb.stack import FrameStack
+
+
+def _write_frame(path: str, value: int):
+    Image.fromarray(np.full((48, 64), value, dtype=np.uint8)).save(path)
+
+
+def test_stack_is_rebuilt_when_a_frame_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("frames")
+    for i in range(4):
+        _write_frame(os.path.join("frames", f"{i:03d}.png"), 10 * i)
+    set_frame_source(FrameSource("frames"))
+
+    stack = FrameStack(16, 12)
+    stack.build(number_of_thread=1, number_of_splits=2)
+    assert stack.is_built()
+    assert stack[2].max() == 20
+
+    # Same name and size, only the content changes, like a re-run of --video.
+    replaced = os.path.join("frames", "002.png")
+    modified = os.stat(replaced).st_mtime_ns
+    _write_frame(replaced, 255 - 20)
+    os.utime(replaced, ns=(modified + 10**9, modified + 10**9))
+    set_frame_source(FrameSource("frames"))
+
+    stack = FrameStack(16, 12)
+    assert not stack.is_built()
+    stack.build(number_of_thread=1, number_of_splits=2)
+    assert stack.is_built()
+    assert stack[2].min() == 255 - 20